@@ -2,5 +2,12 @@ from .metadata import __version__, __author__, __copyright__, __credits__, __lic
 
 from .tools import *
 from .objects import *
+from .initial_conditions import *
 from .simulation import *
+from .compression import *
+from .analysis import *
+from .cache import *
+from .pipeline import *
+from .validation import *
+from .index import *
 
@@ -0,0 +1,363 @@
+"""
+Analysis module
+===============
+
+Contains functions to compute statistics of trajectories as returned
+by :meth:`couzinswarm.simulation.Swarm.simulate`.
+
+All functions iterate over the trajectory in chunks of
+``chunk_length`` frames, such that only a bounded part of the
+trajectory is held in memory. Trajectories can hence either be
+given as arrays of shape ``(N_fish, N_frames, 3)`` (including
+memory-mapped arrays, e.g. from ``numpy.load(..., mmap_mode='r')``)
+or as a :class:`couzinswarm.compression.TrajectoryReader`.
+
+Pairs of fish are found using a grid of cells such that
+the cost per frame scales with the number of close pairs rather
+than with the number of all pairs. Periodic boundaries are
+respected using the minimum image convention.
+"""
+
+import numpy as np
+
+from couzinswarm.tools import minimum_image, neighbor_pairs
+from couzinswarm.engine import _per_fish, _zones, _visible
+from couzinswarm.compression import TrajectoryReader
+
+
+def iter_chunks(positions,directions=None,chunk_length=100,start=0,stop=None):
+    """
+    Iterate over a trajectory in chunks of frames.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray of shape ``(N_fish, N_frames, 3)`` or :class:`couzinswarm.compression.TrajectoryReader`
+        Positions of the fish. If a reader is given, positions and
+        directions are decoded from it and `directions` is ignored.
+    directions : numpy.ndarray of shape ``(N_fish, N_frames, 3)``, default : None
+        Directions of the fish.
+    chunk_length : int, default : 100
+        Maximum number of frames per chunk.
+    start : int, default : 0
+        First frame.
+    stop : int, default : None
+        Frame after the last frame. If `None`, iterate until the end.
+
+    Yields
+    ------
+    t0 : int
+        Index of the first frame of this chunk.
+    positions : numpy.ndarray of shape ``(N_fish, n, 3)``
+    directions : numpy.ndarray of shape ``(N_fish, n, 3)`` or None
+    """
+
+    n_frames = positions.shape[1]
+    if stop is None or stop > n_frames:
+        stop = n_frames
+
+    for t0 in range(start, stop, chunk_length):
+        t1 = min(t0 + chunk_length, stop)
+        if isinstance(positions, TrajectoryReader):
+            r, v = positions.read(t0, t1)
+        else:
+            r = np.asarray(positions[:,t0:t1,:], dtype=float)
+            v = None if directions is None else np.asarray(directions[:,t0:t1,:], dtype=float)
+        yield t0, r, v
+
+
+def pair_correlation(positions,
+                     r_max=10,
+                     n_bins=50,
+                     box_lengths=[100,100,100],
+                     reflect_at_boundary=[True,True,True],
+                     chunk_length=100,
+                     start=0,
+                     stop=None,
+                     ):
+    """
+    Compute the pair correlation function :math:`g(r)`, averaged over frames.
+
+    The pair density is normalized by the mean density within the whole box.
+    No correction for reflecting boundaries is applied, hence :math:`g(r)`
+    of a homogeneous distribution will drop slightly below unity
+    for large `r` in reflecting boxes.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray of shape ``(N_fish, N_frames, 3)`` or :class:`couzinswarm.compression.TrajectoryReader`
+        Positions of the fish.
+    r_max : float, default : 10
+        Maximum distance (unit: fish length).
+    n_bins : int, default : 50
+        Number of distance bins.
+    box_lengths : list or numpy.ndarray of float, default : [100,100,100]
+        Dimensions of the simulation box.
+    reflect_at_boundary : list of bool, default : [True, True, True]
+        Boundary conditions of the simulation box.
+    chunk_length : int, default : 100
+        Number of frames held in memory at once.
+    start : int, default : 0
+        First frame to consider.
+    stop : int, default : None
+        Frame after the last frame to consider.
+
+    Returns
+    -------
+    r : numpy.ndarray of shape ``(n_bins,)``
+        Centers of the distance bins.
+    g : numpy.ndarray of shape ``(n_bins,)``
+        Pair correlation function.
+    """
+
+    N = positions.shape[0]
+    edges = np.linspace(0, r_max, n_bins+1)
+    counts = np.zeros(n_bins)
+    n_frames = 0
+
+    for t0, r, _ in iter_chunks(positions, None, chunk_length, start, stop):
+        for t in range(r.shape[1]):
+            _, _, _, distance = neighbor_pairs(r[:,t,:], r_max, box_lengths, reflect_at_boundary)
+            counts += np.histogram(distance, bins=edges)[0]
+            n_frames += 1
+
+    volume = np.prod(np.asarray(box_lengths, dtype=float))
+    shell_volumes = 4/3 * np.pi * (edges[1:]**3 - edges[:-1]**3)
+    expected = n_frames * 0.5 * N * (N-1) * shell_volumes / volume
+
+    return 0.5 * (edges[1:] + edges[:-1]), counts / expected
+
+
+def nearest_neighbor_distances(positions,
+                               r_max=10,
+                               n_bins=50,
+                               box_lengths=[100,100,100],
+                               reflect_at_boundary=[True,True,True],
+                               chunk_length=100,
+                               start=0,
+                               stop=None,
+                               ):
+    """
+    Compute the histogram of nearest-neighbor distances over all
+    fish and frames.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray of shape ``(N_fish, N_frames, 3)`` or :class:`couzinswarm.compression.TrajectoryReader`
+        Positions of the fish.
+    r_max : float, default : 10
+        Maximum distance up to which neighbors are searched
+        (unit: fish length).
+    n_bins : int, default : 50
+        Number of distance bins.
+    box_lengths : list or numpy.ndarray of float, default : [100,100,100]
+        Dimensions of the simulation box.
+    reflect_at_boundary : list of bool, default : [True, True, True]
+        Boundary conditions of the simulation box.
+    chunk_length : int, default : 100
+        Number of frames held in memory at once.
+    start : int, default : 0
+        First frame to consider.
+    stop : int, default : None
+        Frame after the last frame to consider.
+
+    Returns
+    -------
+    counts : numpy.ndarray of shape ``(n_bins,)``
+        Number of observations per distance bin.
+    bin_edges : numpy.ndarray of shape ``(n_bins+1,)``
+        Edges of the distance bins.
+    n_isolated : int
+        Number of observations in which a fish had no neighbor
+        within `r_max`.
+    """
+
+    N = positions.shape[0]
+    edges = np.linspace(0, r_max, n_bins+1)
+    counts = np.zeros(n_bins, dtype=int)
+    n_isolated = 0
+
+    for t0, r, _ in iter_chunks(positions, None, chunk_length, start, stop):
+        for t in range(r.shape[1]):
+            i, j, _, distance = neighbor_pairs(r[:,t,:], r_max, box_lengths, reflect_at_boundary)
+            nearest = np.full(N, np.inf)
+            np.minimum.at(nearest, i, distance)
+            np.minimum.at(nearest, j, distance)
+            found = np.isfinite(nearest)
+            counts += np.histogram(nearest[found], bins=edges)[0]
+            n_isolated += N - found.sum()
+
+    return counts, edges, int(n_isolated)
+
+
+def zone_occupancy(positions,
+                   directions,
+                   repulsion_radius=1,
+                   orientation_width=10,
+                   attraction_width=10,
+                   angle_of_perception=340/360*np.pi,
+                   box_lengths=[100,100,100],
+                   reflect_at_boundary=[True,True,True],
+                   chunk_length=100,
+                   start=0,
+                   stop=None,
+                   ):
+    """
+    Compute histograms of the number of neighbors in each fish's
+    zones of repulsion, orientation, and attraction.
+
+    Neighbors in the zone of repulsion are always counted, neighbors
+    in the zones of orientation and attraction only if they are within
+    the focal fish's angle of perception, as in
+    :meth:`couzinswarm.simulation.Swarm.simulate`. The behavioral
+    parameters can be given per fish, in which case each fish's
+    neighbors are counted in its own zones.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray of shape ``(N_fish, N_frames, 3)`` or :class:`couzinswarm.compression.TrajectoryReader`
+        Positions of the fish.
+    directions : numpy.ndarray of shape ``(N_fish, N_frames, 3)``
+        Directions of the fish (ignored if `positions` is a reader).
+    repulsion_radius : float or numpy.ndarray of shape ``(N_fish,)``, default : 1.0
+        Radius of the zone of repulsion.
+    orientation_width : float or numpy.ndarray of shape ``(N_fish,)``, default : 10.0
+        Width of the zone of orientation.
+    attraction_width : float or numpy.ndarray of shape ``(N_fish,)``, default : 10.0
+        Width of the zone of attraction.
+    angle_of_perception : float or numpy.ndarray of shape ``(N_fish,)``, default : 340/360*pi
+        Angle in which a fish can see other fish.
+    box_lengths : list or numpy.ndarray of float, default : [100,100,100]
+        Dimensions of the simulation box.
+    reflect_at_boundary : list of bool, default : [True, True, True]
+        Boundary conditions of the simulation box.
+    chunk_length : int, default : 100
+        Number of frames held in memory at once.
+    start : int, default : 0
+        First frame to consider.
+    stop : int, default : None
+        Frame after the last frame to consider.
+
+    Returns
+    -------
+    n_r : numpy.ndarray of shape ``(N_fish,)``
+        ``n_r[k]`` is the number of observations in which a fish had
+        `k` neighbors in its zone of repulsion.
+    n_o : numpy.ndarray of shape ``(N_fish,)``
+        Same for the zone of orientation.
+    n_a : numpy.ndarray of shape ``(N_fish,)``
+        Same for the zone of attraction.
+    """
+
+    N = positions.shape[0]
+    r_a = np.max(np.asarray(repulsion_radius) + orientation_width + attraction_width)
+
+    hist_r = np.zeros(N, dtype=int)
+    hist_o = np.zeros(N, dtype=int)
+    hist_a = np.zeros(N, dtype=int)
+
+    for t0, r, v in iter_chunks(positions, directions, chunk_length, start, stop):
+        for t in range(r.shape[1]):
+            i, j, r_ij, distance = neighbor_pairs(r[:,t,:], r_a, box_lengths, reflect_at_boundary)
+            e_ij = r_ij / distance[:,None]
+
+            # i sees j if the angle between i's direction and r_ij is small enough,
+            # j sees i if the angle between j's direction and r_ji is small enough
+            i_sees_j = _visible(e_ij, v[i,t,:], _per_fish(angle_of_perception, i))
+            j_sees_i = _visible(-e_ij, v[j,t,:], _per_fish(angle_of_perception, j))
+
+            # each fish counts its neighbors in its own zones
+            repulsion_i, orientation_i, attraction_i = _zones(distance, i, repulsion_radius, orientation_width, attraction_width)
+            repulsion_j, orientation_j, attraction_j = _zones(distance, j, repulsion_radius, orientation_width, attraction_width)
+
+            n_r = np.bincount(i[repulsion_i], minlength=N) + \
+                  np.bincount(j[repulsion_j], minlength=N)
+            n_o = np.bincount(i[orientation_i & i_sees_j], minlength=N) + \
+                  np.bincount(j[orientation_j & j_sees_i], minlength=N)
+            n_a = np.bincount(i[attraction_i & i_sees_j], minlength=N) + \
+                  np.bincount(j[attraction_j & j_sees_i], minlength=N)
+
+            hist_r += np.bincount(n_r, minlength=N)
+            hist_o += np.bincount(n_o, minlength=N)
+            hist_a += np.bincount(n_a, minlength=N)
+
+    return hist_r, hist_o, hist_a
+
+
+def speed_and_turn_statistics(positions,
+                              directions,
+                              dt=0.1,
+                              box_lengths=[100,100,100],
+                              reflect_at_boundary=[True,True,True],
+                              chunk_length=100,
+                              start=0,
+                              stop=None,
+                              ):
+    """
+    Compute the mean and standard deviation of each fish's speed
+    and turning rate.
+
+    Displacements across periodic boundaries are mapped to their
+    minimum image.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray of shape ``(N_fish, N_frames, 3)`` or :class:`couzinswarm.compression.TrajectoryReader`
+        Positions of the fish.
+    directions : numpy.ndarray of shape ``(N_fish, N_frames, 3)``
+        Directions of the fish (ignored if `positions` is a reader).
+    dt : float, default : 0.1
+        Time between two frames.
+    box_lengths : list or numpy.ndarray of float, default : [100,100,100]
+        Dimensions of the simulation box.
+    reflect_at_boundary : list of bool, default : [True, True, True]
+        Boundary conditions of the simulation box.
+    chunk_length : int, default : 100
+        Number of frames held in memory at once.
+    start : int, default : 0
+        First frame to consider.
+    stop : int, default : None
+        Frame after the last frame to consider.
+
+    Returns
+    -------
+    mean_speed : numpy.ndarray of shape ``(N_fish,)``
+    std_speed : numpy.ndarray of shape ``(N_fish,)``
+    mean_turning_rate : numpy.ndarray of shape ``(N_fish,)``
+        Mean angle between consecutive directions per unit time
+        (unit: radians per unit time).
+    std_turning_rate : numpy.ndarray of shape ``(N_fish,)``
+    """
+
+    N = positions.shape[0]
+    sums = np.zeros((4,N))
+    n = 0
+    last_r = last_v = None
+
+    for t0, r, v in iter_chunks(positions, directions, chunk_length, start, stop):
+
+        # prepend the last frame of the previous chunk
+        if last_r is not None:
+            r = np.concatenate((last_r, r), axis=1)
+            v = np.concatenate((last_v, v), axis=1)
+        last_r, last_v = r[:,-1:,:], v[:,-1:,:]
+
+        if r.shape[1] < 2:
+            continue
+
+        dr = minimum_image(np.diff(r, axis=1), box_lengths, reflect_at_boundary)
+        speed = np.linalg.norm(dr, axis=2) / dt
+        cos = np.clip(np.einsum('itk,itk->it', v[:,1:,:], v[:,:-1,:]), -1, 1)
+        turning_rate = np.arccos(cos) / dt
+
+        sums += [ speed.sum(1), (speed**2).sum(1), turning_rate.sum(1), (turning_rate**2).sum(1) ]
+        n += speed.shape[1]
+
+    if n == 0:
+        raise ValueError("at least two frames are needed")
+
+    mean_speed = sums[0] / n
+    mean_turning_rate = sums[2] / n
+    std_speed = np.sqrt(np.maximum(sums[1] / n - mean_speed**2, 0))
+    std_turning_rate = np.sqrt(np.maximum(sums[3] / n - mean_turning_rate**2, 0))
+
+    return mean_speed, std_speed, mean_turning_rate, std_turning_rate
@@ -0,0 +1,221 @@
+"""
+Cache module
+============
+
+Contains the `StateCache` class, an on-disk cache of equilibrated
+swarm states, such that the burn-in phase of a simulation does not
+have to be repeated for every replica or restart.
+"""
+
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from couzinswarm.metadata import __version__
+
+_PARAMETERS = [
+        'number_of_fish',
+        'repulsion_radius',
+        'orientation_width',
+        'attraction_width',
+        'angle_of_perception',
+        'turning_rate',
+        'speed',
+        'noise_sigma',
+        'dt',
+        'box_lengths',
+        'reflect_at_boundary',
+        'opening_angle',
+        'engine',
+    ]
+
+
+class StateCache:
+    """An on-disk cache of equilibrated swarm states.
+
+    States are keyed by a hash of the model parameters (including the
+    engine and the octree's opening angle, which change the dynamics), the number
+    of fish, the number of burn-in steps, and the package version.
+    When the total size of the cache exceeds ``max_bytes``,
+    the least recently used states are removed.
+
+    Loading a state only restores positions and directions. The
+    random number generator is left untouched, so swarms started from
+    the same cached state still receive fresh noise.
+
+    Attributes
+    ----------
+    directory : str
+        Directory in which the states are saved.
+    max_bytes : int
+        Maximum total size of all cached states (unit: bytes).
+
+    Example
+    -------
+
+    >>> cache = StateCache('~/.couzinswarm_cache')
+    >>> swarm = Swarm(number_of_fish=100)
+    >>> cache.equilibrate(swarm, 5000)
+    >>> r, v = swarm.simulate(1000)
+    """
+
+    def __init__(self,directory,max_bytes=1024**3):
+        """
+        Open (and create if necessary) a cache directory.
+
+        Parameters
+        ----------
+        directory : str
+            Directory in which the states are saved.
+        max_bytes : int, default : 1024**3
+            Maximum total size of all cached states (unit: bytes).
+        """
+
+        self.directory = os.path.expanduser(directory)
+        self.max_bytes = max_bytes
+        os.makedirs(self.directory, exist_ok=True)
+
+    def key(self,swarm,N_time_steps):
+        """
+        Return the key under which the state of `swarm`
+        after `N_time_steps` burn-in steps is cached.
+        """
+
+        parameters = { name: np.asarray(getattr(swarm, name)).tolist() for name in _PARAMETERS }
+        parameters['N_time_steps'] = int(N_time_steps)
+        parameters['version'] = __version__
+        serialized = json.dumps(parameters, sort_keys=True)
+
+        return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+    def _path(self,key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def __contains__(self,key):
+        return os.path.exists(self._path(key))
+
+    def load(self,swarm,N_time_steps):
+        """
+        Set the fish of `swarm` to the cached state, if available.
+
+        Parameters
+        ----------
+        swarm : :class:`couzinswarm.simulation.Swarm`
+            The swarm to be initialized.
+        N_time_steps : int
+            Number of burn-in steps of the requested state.
+
+        Returns
+        -------
+        found : bool
+            Whether a cached state was found.
+        """
+
+        path = self._path(self.key(swarm, N_time_steps))
+
+        try:
+            with np.load(path) as data:
+                positions = data['positions']
+                directions = data['directions']
+        except (OSError, KeyError, ValueError):
+            return False
+
+        # mark as recently used
+        os.utime(path, None)
+
+        swarm.set_state(positions, directions)
+
+        return True
+
+    def store(self,swarm,N_time_steps):
+        """
+        Save the current state of `swarm` as the state
+        after `N_time_steps` burn-in steps.
+        """
+
+        path = self._path(self.key(swarm, N_time_steps))
+        positions, directions = swarm.get_state()
+
+        # write to a temporary file first such that concurrent
+        # readers never see partially written states
+        tmp_path = path[:-len('.npz')] + '.%d.tmp.npz' % os.getpid()
+        np.savez(tmp_path, positions=positions, directions=directions)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def equilibrate(self,swarm,N_time_steps):
+        """
+        Bring `swarm` into an equilibrated state, either by loading
+        it from the cache or by simulating `N_time_steps` burn-in
+        steps and caching the result.
+
+        The initial condition is not part of the key. If a state is
+        found, the current state of `swarm` (e.g. one set with
+        :meth:`couzinswarm.simulation.Swarm.set_state`) is discarded and
+        replaced by a state that may have been burned in from a
+        different start. Since the collective state (swarm, mill, polarized
+        school) depends on the history, use separate cache directories for
+        different initial conditions.
+
+        Parameters
+        ----------
+        swarm : :class:`couzinswarm.simulation.Swarm`
+            The swarm to be equilibrated.
+        N_time_steps : int
+            Number of burn-in steps.
+
+        Returns
+        -------
+        found : bool
+            Whether the state was loaded from the cache.
+        """
+
+        if self.load(swarm, N_time_steps):
+            return True
+
+        swarm.simulate(N_time_steps, record=False)
+        self.store(swarm, N_time_steps)
+
+        return False
+
+    def evict(self):
+        """
+        Remove the least recently used states until the total size
+        of the cache is not larger than ``self.max_bytes``.
+        """
+
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith('.npz') or name.endswith('.tmp.npz'):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        entries.sort()
+        total = sum(e[1] for e in entries)
+
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        """
+        Remove all cached states.
+        """
+
+        max_bytes = self.max_bytes
+        self.max_bytes = -1
+        self.evict()
+        self.max_bytes = max_bytes
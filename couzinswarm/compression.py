@@ -0,0 +1,533 @@
+"""
+Compression module
+==================
+
+Contains a compact on-disk format for trajectories as returned by
+:meth:`couzinswarm.simulation.Swarm.simulate`.
+
+Directions are stored in an octahedral encoding with a configurable
+number of bits per component. Positions are stored as quantized
+deltas relative to a keyframe which is saved at the start of
+each block of frames. Every block can be decoded independently
+of all other blocks.
+"""
+
+import struct
+import zlib
+
+import numpy as np
+
+_MAGIC = b"CZSWTRJ1"
+_FILE_HEADER = struct.Struct("<IIdI")
+_BLOCK_HEADER = struct.Struct("<QIcQ")
+_DELTA_DTYPES = [np.int8, np.int16, np.int32, np.int64]
+# platform-independent codes (as in the struct module) of the delta types
+_DELTA_CODES = { 'b': '<i1', 'h': '<i2', 'i': '<i4', 'q': '<i8' }
+
+
+def _delta_code(dtype):
+    """
+    Return the code of the integer type `dtype` stored in block headers.
+    """
+    return { 1: b'b', 2: b'h', 4: b'i', 8: b'q' }[np.dtype(dtype).itemsize]
+
+
+def octahedral_encode(directions,bits=8):
+    """
+    Encode unit vectors as two unsigned integers each using the
+    octahedral mapping of the sphere onto the unit square.
+
+    Parameters
+    ----------
+    directions : numpy.ndarray of shape ``(..., 3)``
+        Direction vectors (do not need to be normalized).
+    bits : int, default : 8
+        Number of bits per component (at most 16).
+
+    Returns
+    -------
+    codes : numpy.ndarray of shape ``(..., 2)``
+        Encoded directions of dtype ``uint8`` for ``bits <= 8``
+        and ``uint16`` otherwise.
+    """
+
+    if not 2 <= bits <= 16:
+        raise ValueError("`bits` has to be between 2 and 16")
+
+    v = np.asarray(directions,dtype=float)
+    v = v / np.abs(v).sum(axis=-1,keepdims=True)
+    x, y, z = v[...,0], v[...,1], v[...,2]
+
+    # fold the lower hemisphere onto the outer triangles of the square
+    sx = np.where(x >= 0, 1.0, -1.0)
+    sy = np.where(y >= 0, 1.0, -1.0)
+    lower = z < 0
+    x, y = np.where(lower, (1-np.abs(y))*sx, x), np.where(lower, (1-np.abs(x))*sy, y)
+
+    levels = 2**bits - 1
+    dtype = np.uint8 if bits <= 8 else np.uint16
+    codes = np.rint((np.stack((x,y),axis=-1)*0.5 + 0.5) * levels)
+
+    return codes.astype(dtype)
+
+
+def octahedral_decode(codes,bits=8):
+    """
+    Decode unit vectors from their octahedral encoding.
+
+    Parameters
+    ----------
+    codes : numpy.ndarray of shape ``(..., 2)``
+        Encoded directions as returned by :func:`octahedral_encode`.
+    bits : int, default : 8
+        Number of bits per component that was used for encoding.
+
+    Returns
+    -------
+    directions : numpy.ndarray of shape ``(..., 3)``
+        Decoded unit vectors.
+    """
+
+    levels = 2**bits - 1
+    uv = np.asarray(codes,dtype=float) / levels * 2 - 1
+    x, y = uv[...,0], uv[...,1]
+    z = 1 - np.abs(x) - np.abs(y)
+
+    # unfold the outer triangles back onto the lower hemisphere
+    t = np.maximum(-z, 0)
+    x = x - t * np.where(x >= 0, 1.0, -1.0)
+    y = y - t * np.where(y >= 0, 1.0, -1.0)
+
+    v = np.stack((x,y,z),axis=-1)
+    v /= np.linalg.norm(v,axis=-1,keepdims=True)
+
+    return v
+
+
+class TrajectoryWriter:
+    """Write a trajectory in compressed blocks to a file.
+
+    Frames can be appended one at a time (e.g. during a simulation)
+    or as whole arrays. Once ``block_length`` frames have been collected,
+    they are quantized, compressed and written as one block.
+
+    Positions are quantized on a grid of width ``2*position_tolerance``,
+    such that every decoded position deviates by at most
+    ``position_tolerance`` in each dimension from the original one.
+    The angular error of decoded directions is at most about
+    ``4.4/2**direction_bits`` radians (roughly 0.017 for the default of 8 bits).
+
+    Attributes
+    ----------
+    number_of_fish : int
+        Number of fish per frame.
+    position_tolerance : float
+        Maximum absolute error of each position component.
+    direction_bits : int
+        Number of bits per octahedral component of the directions.
+    block_length : int
+        Number of frames per block.
+    number_of_frames : int
+        Number of frames that have been handed to the writer so far.
+
+    Example
+    -------
+
+    >>> r, v = swarm.simulate(1000)
+    >>> with TrajectoryWriter('run.czt', swarm.number_of_fish) as writer:
+    ...     writer.write(r, v)
+    """
+
+    def __init__(self,
+                 file,
+                 number_of_fish,
+                 position_tolerance=1e-3,
+                 direction_bits=8,
+                 block_length=100,
+                 compression_level=6,
+                 ):
+        """
+        Open a new compressed trajectory file.
+
+        Parameters
+        ----------
+        file : str or file-like object
+            Filename or binary file object to write to. If a filename
+            is given, the file is closed by :meth:`close`.
+        number_of_fish : int
+            Number of fish per frame.
+        position_tolerance : float, default : 1e-3
+            Maximum absolute error of each position component
+            (unit: fish length).
+        direction_bits : int, default : 8
+            Number of bits per octahedral component of the directions
+            (i.e. 16 bits per direction for the default value).
+        block_length : int, default : 100
+            Number of frames per independently decodable block.
+        compression_level : int, default : 6
+            zlib compression level of each block.
+        """
+
+        if position_tolerance <= 0:
+            raise ValueError("`position_tolerance` has to be positive")
+        if not 2 <= direction_bits <= 16:
+            raise ValueError("`direction_bits` has to be between 2 and 16")
+        if block_length < 1:
+            raise ValueError("`block_length` has to be at least 1")
+
+        self.number_of_fish = int(number_of_fish)
+        self.position_tolerance = float(position_tolerance)
+        self.direction_bits = int(direction_bits)
+        self.block_length = int(block_length)
+        self.compression_level = compression_level
+        self.number_of_frames = 0
+
+        if hasattr(file, 'write'):
+            self._file = file
+            self._owns_file = False
+        else:
+            self._file = open(file, 'wb')
+            self._owns_file = True
+
+        self._file.write(_MAGIC)
+        self._file.write(_FILE_HEADER.pack(self.number_of_fish,
+                                           self.block_length,
+                                           self.position_tolerance,
+                                           self.direction_bits,
+                                           ))
+
+        self._positions = np.empty((self.number_of_fish,self.block_length,3))
+        self._directions = np.empty((self.number_of_fish,self.block_length,3))
+        self._n_buffered = 0
+        self._block_start = 0
+
+    def append(self,positions,directions):
+        """
+        Append a single frame.
+
+        Parameters
+        ----------
+        positions : numpy.ndarray of shape ``(number_of_fish, 3)``
+        directions : numpy.ndarray of shape ``(number_of_fish, 3)``
+        """
+
+        self._positions[:,self._n_buffered,:] = positions
+        self._directions[:,self._n_buffered,:] = directions
+        self._n_buffered += 1
+        self.number_of_frames += 1
+
+        if self._n_buffered == self.block_length:
+            self.flush()
+
+    def write(self,positions,directions):
+        """
+        Append several frames.
+
+        Parameters
+        ----------
+        positions : numpy.ndarray of shape ``(number_of_fish, N_frames, 3)``
+        directions : numpy.ndarray of shape ``(number_of_fish, N_frames, 3)``
+        """
+
+        n_frames = positions.shape[1]
+        if directions.shape[1] != n_frames:
+            raise ValueError("`positions` and `directions` contain different numbers of frames")
+
+        t = 0
+        while t < n_frames:
+            n = min(n_frames - t, self.block_length - self._n_buffered)
+            sl = slice(self._n_buffered, self._n_buffered + n)
+            self._positions[:,sl,:] = positions[:,t:t+n,:]
+            self._directions[:,sl,:] = directions[:,t:t+n,:]
+            self._n_buffered += n
+            self.number_of_frames += n
+            t += n
+
+            if self._n_buffered == self.block_length:
+                self.flush()
+
+    def flush(self):
+        """
+        Encode and write all buffered frames as a (possibly short) block.
+        """
+
+        n = self._n_buffered
+        if n == 0:
+            return
+
+        r = self._positions[:,:n,:]
+        q = 2 * self.position_tolerance
+
+        # quantize all positions relative to the keyframe and
+        # store the differences between consecutive frames
+        keyframe = r[:,0,:].copy()
+        k = np.rint((r[:,1:,:] - keyframe[:,None,:]) / q).astype(np.int64)
+        deltas = np.diff(k, axis=1, prepend=0)
+
+        delta_dtype = _DELTA_DTYPES[-1]
+        if deltas.size > 0:
+            lo, hi = deltas.min(), deltas.max()
+            for dtype in _DELTA_DTYPES:
+                info = np.iinfo(dtype)
+                if info.min <= lo and hi <= info.max:
+                    delta_dtype = dtype
+                    break
+        else:
+            delta_dtype = _DELTA_DTYPES[0]
+
+        codes = octahedral_encode(self._directions[:,:n,:], self.direction_bits)
+
+        payload = zlib.compress(
+                    keyframe.astype('<f8').tobytes() + \
+                    deltas.astype(np.dtype(delta_dtype).newbyteorder('<')).tobytes() + \
+                    codes.astype(codes.dtype.newbyteorder('<')).tobytes(),
+                    self.compression_level,
+                  )
+
+        self._file.write(_BLOCK_HEADER.pack(self._block_start,
+                                            n,
+                                            _delta_code(delta_dtype),
+                                            len(payload),
+                                            ))
+        self._file.write(payload)
+
+        self._block_start += n
+        self._n_buffered = 0
+
+    def close(self):
+        """
+        Write the remaining frames and close the file if it was
+        opened by the writer.
+        """
+
+        self.flush()
+        if self._owns_file:
+            self._file.close()
+        else:
+            self._file.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class TrajectoryReader:
+    """Read a trajectory written by :class:`TrajectoryWriter`.
+
+    Opening a file only reads the block headers, frames are decoded
+    lazily on request, one block at a time.
+
+    Attributes
+    ----------
+    number_of_fish : int
+        Number of fish per frame.
+    number_of_frames : int
+        Total number of frames in the file.
+    shape : tuple of int
+        ``(number_of_fish, number_of_frames, 3)``, the shape of the
+        decoded position and direction arrays.
+    position_tolerance : float
+        Maximum absolute error of each position component.
+    direction_bits : int
+        Number of bits per octahedral component of the directions.
+    block_length : int
+        Number of frames per block.
+    block_starts : numpy.ndarray of int
+        Index of the first frame of each block.
+
+    Example
+    -------
+
+    >>> with TrajectoryReader('run.czt') as reader:
+    ...     for t0, r, v in reader.iter_blocks():
+    ...         pass
+    """
+
+    def __init__(self,file):
+        """
+        Open a compressed trajectory file.
+
+        Parameters
+        ----------
+        file : str or file-like object
+            Filename or seekable binary file object to read from.
+        """
+
+        if hasattr(file, 'read'):
+            self._file = file
+            self._owns_file = False
+        else:
+            self._file = open(file, 'rb')
+            self._owns_file = True
+
+        if self._file.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError("not a compressed couzinswarm trajectory")
+
+        self.number_of_fish, \
+        self.block_length, \
+        self.position_tolerance, \
+        self.direction_bits = _FILE_HEADER.unpack(self._file.read(_FILE_HEADER.size))
+
+        self._code_dtype = np.dtype(np.uint8 if self.direction_bits <= 8 else np.uint16).newbyteorder('<')
+
+        # scan the block headers and remember where the payloads are
+        self._blocks = []
+        while True:
+            header = self._file.read(_BLOCK_HEADER.size)
+            if len(header) < _BLOCK_HEADER.size:
+                break
+            start, n, code, length = _BLOCK_HEADER.unpack(header)
+            code = code.decode('ascii')
+            if code not in _DELTA_CODES:
+                raise ValueError("unknown delta type %r in block starting at frame %d" % (code, start))
+            self._blocks.append((start, n, _DELTA_CODES[code], self._file.tell(), length))
+            self._file.seek(length, 1)
+
+        self.block_starts = np.array([ b[0] for b in self._blocks ], dtype=int)
+        self.number_of_frames = sum(b[1] for b in self._blocks)
+        self.shape = (self.number_of_fish, self.number_of_frames, 3)
+
+    def __len__(self):
+        return len(self._blocks)
+
+    def read_block(self,k):
+        """
+        Decode a single block.
+
+        Parameters
+        ----------
+        k : int
+            Index of the block.
+
+        Returns
+        -------
+        start : int
+            Index of the first frame in this block.
+        positions : numpy.ndarray of shape ``(number_of_fish, n, 3)``
+        directions : numpy.ndarray of shape ``(number_of_fish, n, 3)``
+        """
+
+        start, n, delta_dtype, offset, length = self._blocks[k]
+        N = self.number_of_fish
+
+        self._file.seek(offset)
+        data = zlib.decompress(self._file.read(length))
+
+        delta_dtype = np.dtype(delta_dtype)
+        n_key = N * 3 * 8
+        n_delta = N * (n-1) * 3 * delta_dtype.itemsize
+
+        keyframe = np.frombuffer(data, dtype='<f8', count=N*3).reshape(N,1,3)
+        deltas = np.frombuffer(data, dtype=delta_dtype, count=N*(n-1)*3, offset=n_key).reshape(N,n-1,3)
+        codes = np.frombuffer(data, dtype=self._code_dtype, count=N*n*2, offset=n_key+n_delta).reshape(N,n,2)
+
+        positions = np.empty((N,n,3))
+        positions[:,:1,:] = keyframe
+        q = 2 * self.position_tolerance
+        positions[:,1:,:] = keyframe + np.cumsum(deltas, axis=1, dtype=np.int64) * q
+
+        directions = octahedral_decode(codes, self.direction_bits)
+
+        return start, positions, directions
+
+    def iter_blocks(self,start=0,stop=None):
+        """
+        Iterate over all blocks which contain frames in ``[start, stop)``.
+
+        Yields
+        ------
+        start : int
+            Index of the first frame in the block.
+        positions : numpy.ndarray of shape ``(number_of_fish, n, 3)``
+        directions : numpy.ndarray of shape ``(number_of_fish, n, 3)``
+        """
+
+        if stop is None:
+            stop = self.number_of_frames
+
+        first = max(0, np.searchsorted(self.block_starts, start, side='right') - 1)
+        for k in range(first, len(self._blocks)):
+            if self._blocks[k][0] >= stop:
+                break
+            yield self.read_block(k)
+
+    def read(self,start=0,stop=None):
+        """
+        Decode the frames ``[start, stop)``.
+
+        Returns
+        -------
+        positions : numpy.ndarray of shape ``(number_of_fish, stop-start, 3)``
+        directions : numpy.ndarray of shape ``(number_of_fish, stop-start, 3)``
+        """
+
+        if stop is None:
+            stop = self.number_of_frames
+        start = max(0, start)
+        stop = min(stop, self.number_of_frames)
+
+        positions = np.empty((self.number_of_fish,max(0,stop-start),3))
+        directions = np.empty_like(positions)
+
+        for t0, r, v in self.iter_blocks(start, stop):
+            lo = max(start, t0)
+            hi = min(stop, t0 + r.shape[1])
+            positions[:,lo-start:hi-start,:] = r[:,lo-t0:hi-t0,:]
+            directions[:,lo-start:hi-start,:] = v[:,lo-t0:hi-t0,:]
+
+        return positions, directions
+
+    def close(self):
+        """
+        Close the file if it was opened by the reader.
+        """
+
+        if self._owns_file:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def compress_trajectory(file,positions,directions,**kwargs):
+    """
+    Write a whole trajectory to a compressed file.
+
+    Parameters
+    ----------
+    file : str or file-like object
+        Filename or binary file object to write to.
+    positions : numpy.ndarray of shape ``(N_fish, N_frames, 3)``
+        Positions as returned by :meth:`couzinswarm.simulation.Swarm.simulate`.
+    directions : numpy.ndarray of shape ``(N_fish, N_frames, 3)``
+        Directions as returned by :meth:`couzinswarm.simulation.Swarm.simulate`.
+    **kwargs
+        Passed on to :class:`TrajectoryWriter`.
+    """
+
+    with TrajectoryWriter(file, positions.shape[0], **kwargs) as writer:
+        writer.write(positions, directions)
+
+
+def decompress_trajectory(file):
+    """
+    Read a whole trajectory from a compressed file.
+
+    Parameters
+    ----------
+    file : str or file-like object
+        Filename or binary file object to read from.
+
+    Returns
+    -------
+    positions : numpy.ndarray of shape ``(N_fish, N_frames, 3)``
+    directions : numpy.ndarray of shape ``(N_fish, N_frames, 3)``
+    """
+
+    with TrajectoryReader(file) as reader:
+        return reader.read()
@@ -0,0 +1,427 @@
+"""
+Engine module
+=============
+
+Contains array-based versions of the update rules in
+:meth:`couzinswarm.simulation.Swarm.simulate` and
+:meth:`couzinswarm.objects.Fish.evaluate_direction`, which
+update all fish at once instead of looping over fish objects.
+
+Optionally, the influence of distant fish in the zone of attraction
+can be approximated using an octree (Barnes-Hut style), such that
+a time step costs :math:`O(N\\log N)` operations for large, dense schools.
+"""
+
+import numpy as np
+
+from couzinswarm.tools import minimum_image, morton_codes
+
+_OCTREE_DEPTH = 10
+
+
+def _scatter_add(index, values, N):
+    """
+    Return the sums of `values` (shape ``(M, 3)``) grouped by `index`,
+    as an array of shape ``(N, 3)``.
+    """
+    return np.stack([ np.bincount(index, weights=values[:,dim], minlength=N) for dim in range(3) ], axis=1)
+
+
+def _per_fish(value, index):
+    """
+    Return the values of a scalar or per-fish parameter for the fish in `index`.
+    """
+    return value[index] if np.ndim(value) > 0 else value
+
+
+def _zones(distance, index, repulsion_radius, orientation_width, attraction_width):
+    """
+    Return masks of the pairs at `distance` that lie within the zones of
+    repulsion, orientation, and attraction of the fish in `index`.
+    """
+    r_r = _per_fish(repulsion_radius, index)
+    r_o = r_r + _per_fish(orientation_width, index)
+    r_a = r_o + _per_fish(attraction_width, index)
+
+    repulsion = distance < r_r
+    orientation = ~repulsion & (distance < r_o)
+    attraction = ~repulsion & ~orientation & (distance < r_a)
+
+    return repulsion, orientation, attraction
+
+
+def _visible(e, v, angle_of_perception):
+    """
+    Whether the unit vectors `e` point into the perception cone
+    of fish with directions `v`.
+    """
+    return np.arccos(np.clip(np.einsum('ij,ij->i', e, v), -1.0, 1.0)) < angle_of_perception
+
+
+def zone_influences(positions,
+                    directions,
+                    i,
+                    j,
+                    r_ij,
+                    distance,
+                    repulsion_radius,
+                    orientation_width,
+                    attraction_width,
+                    angle_of_perception,
+                    ):
+    """
+    Collect the directional influences of all given pairs of fish.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray of shape ``(N, 3)``
+        Positions of all fish.
+    directions : numpy.ndarray of shape ``(N, 3)``
+        Directions of all fish.
+    i, j : numpy.ndarray of int
+        Indices of the interacting pairs.
+    r_ij : numpy.ndarray of shape ``(M, 3)``
+        Vectors pointing from fish `i` to fish `j`.
+    distance : numpy.ndarray of shape ``(M,)``
+        Norms of `r_ij`.
+    repulsion_radius, orientation_width, attraction_width, angle_of_perception : float or numpy.ndarray of shape ``(N,)``
+        Model parameters, see :class:`couzinswarm.simulation.Swarm`.
+        Each fish perceives its neighbors according to its own parameters.
+
+    Returns
+    -------
+    d_r, d_o, d_a : numpy.ndarray of shape ``(N, 3)``
+        Summed directional influences in the zones of repulsion,
+        orientation, and attraction.
+    n_r, n_o, n_a : numpy.ndarray of shape ``(N,)``
+        Number of fish in the zones of repulsion, orientation, and attraction.
+    """
+
+    N = positions.shape[0]
+    e_ij = r_ij / distance[:,None]
+    v_i = directions[i]
+    v_j = directions[j]
+
+    repulsion_i, orientation_i, attraction_i = _zones(distance, i, repulsion_radius, orientation_width, attraction_width)
+    i_sees_j = _visible(e_ij, v_i, _per_fish(angle_of_perception, i))
+    j_sees_i = _visible(-e_ij, v_j, _per_fish(angle_of_perception, j))
+
+    # with identical parameters for all fish, the zones are symmetric
+    if any(np.ndim(x) > 0 for x in (repulsion_radius, orientation_width, attraction_width)):
+        repulsion_j, orientation_j, attraction_j = _zones(distance, j, repulsion_radius, orientation_width, attraction_width)
+    else:
+        repulsion_j, orientation_j, attraction_j = repulsion_i, orientation_i, attraction_i
+
+    # repulsion is felt regardless of the angle of perception
+    d_r = _scatter_add(j[repulsion_j], e_ij[repulsion_j], N) - \
+          _scatter_add(i[repulsion_i], e_ij[repulsion_i], N)
+    n_r = np.bincount(i[repulsion_i], minlength=N) + np.bincount(j[repulsion_j], minlength=N)
+
+    a, b = orientation_i & i_sees_j, orientation_j & j_sees_i
+    d_o = _scatter_add(i[a], v_j[a], N) + _scatter_add(j[b], v_i[b], N)
+    n_o = np.bincount(i[a], minlength=N) + np.bincount(j[b], minlength=N)
+
+    a, b = attraction_i & i_sees_j, attraction_j & j_sees_i
+    d_a = _scatter_add(i[a], e_ij[a], N) - _scatter_add(j[b], e_ij[b], N)
+    n_a = np.bincount(i[a], minlength=N) + np.bincount(j[b], minlength=N)
+
+    return d_r, d_o, d_a, n_r, n_o, n_a
+
+
+def build_octree(positions,box_lengths,max_depth=_OCTREE_DEPTH):
+    """
+    Build an octree over `positions` by sorting them along a Morton curve.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray of shape ``(N, 3)``
+        Positions of all fish.
+    box_lengths : numpy.ndarray of float
+        Dimensions of the simulation box.
+    max_depth : int, default : 10
+        Number of levels below the root.
+
+    Returns
+    -------
+    order : numpy.ndarray of int
+        Indices of the fish sorted along the Morton curve.
+    levels : list of tuple
+        For each level, the arrays ``(starts, ends, centers_of_mass,
+        box_centers, box_half_widths)`` of all non-empty nodes, where
+        ``order[starts[k]:ends[k]]`` are the fish in node `k` and the box
+        is the tight bounding box of these fish.
+    """
+
+    codes = morton_codes(positions, box_lengths, max_depth)
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    r = positions[order]
+    N = len(order)
+
+    levels = []
+    for level in range(max_depth+1):
+        prefix = codes >> (3 * (max_depth - level))
+        starts = np.flatnonzero(np.concatenate(([True], prefix[1:] != prefix[:-1])))
+        ends = np.append(starts[1:], N)
+        counts = ends - starts
+        com = np.add.reduceat(r, starts, axis=0) / counts[:,None]
+        lo = np.minimum.reduceat(r, starts, axis=0)
+        hi = np.maximum.reduceat(r, starts, axis=0)
+        levels.append((starts, ends, com, 0.5*(lo+hi), 0.5*(hi-lo)))
+
+    return order, levels
+
+
+def octree_attraction(positions,
+                      directions,
+                      orientation_radius,
+                      attraction_radius,
+                      angle_of_perception,
+                      opening_angle,
+                      box_lengths,
+                      reflect_at_boundary,
+                      leaf_size=8,
+                      ):
+    """
+    Approximate the influences within the zone of attraction using an octree.
+
+    Nodes that lie entirely within a fish's zone of attraction and appear
+    under an angle smaller than `opening_angle` (node size divided by the distance
+    to the node's center of mass) are treated as if all of their fish were
+    located at the center of mass. All other nodes are opened or, if they
+    contain at most `leaf_size` fish, evaluated exactly. An `opening_angle` of
+    zero hence yields the exact result.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray of shape ``(N, 3)``
+        Positions of all fish.
+    directions : numpy.ndarray of shape ``(N, 3)``
+        Directions of all fish.
+    orientation_radius : float or numpy.ndarray of shape ``(N,)``
+        Inner radius of the zone of attraction (``repulsion_radius + orientation_width``).
+    attraction_radius : float or numpy.ndarray of shape ``(N,)``
+        Outer radius of the zone of attraction.
+    angle_of_perception : float or numpy.ndarray of shape ``(N,)``
+        Angle in which a fish can see other fish.
+    opening_angle : float
+        Accuracy parameter, smaller is more accurate.
+    box_lengths : numpy.ndarray of float
+        Dimensions of the simulation box.
+    reflect_at_boundary : list of bool
+        Boundary conditions of the simulation box.
+    leaf_size : int, default : 8
+        Nodes with at most this number of fish are not opened.
+
+    Returns
+    -------
+    d_a : numpy.ndarray of shape ``(N, 3)``
+        Summed unit vectors pointing to the fish in the zone of attraction.
+    n_a : numpy.ndarray of shape ``(N,)``
+        Number of fish in the zone of attraction.
+    """
+
+    N = positions.shape[0]
+    order, levels = build_octree(positions, box_lengths)
+
+    d_a = np.zeros((N,3))
+    n_a = np.zeros(N, dtype=int)
+
+    # pairs of (fish, node) that still have to be evaluated
+    fish = np.arange(N)
+    node = np.zeros(N, dtype=int)
+
+    for level, (starts, ends, com, center, half) in enumerate(levels):
+
+        if len(fish) == 0:
+            break
+
+        delta = np.abs(minimum_image(center[node] - positions[fish], box_lengths, reflect_at_boundary))
+        gap = np.linalg.norm(np.maximum(delta - half[node], 0), axis=1)
+        extent = np.linalg.norm(delta + half[node], axis=1)
+
+        # discard nodes that lie completely outside of the zone of attraction
+        r_o = _per_fish(orientation_radius, fish)
+        r_a = _per_fish(attraction_radius, fish)
+        relevant = (gap < r_a) & (extent >= r_o)
+        fish, node = fish[relevant], node[relevant]
+        gap, extent = gap[relevant], extent[relevant]
+        r_o, r_a = _per_fish(r_o, relevant), _per_fish(r_a, relevant)
+
+        counts = ends[node] - starts[node]
+        r_com = minimum_image(com[node] - positions[fish], box_lengths, reflect_at_boundary)
+        d_com = np.linalg.norm(r_com, axis=1)
+        size = 2 * half[node].max(axis=1)
+
+        inside = (gap >= r_o) & (extent < r_a)
+        accept = inside & (size < opening_angle * d_com)
+        leaf = ~accept & ((counts <= leaf_size) | (level == len(levels)-1))
+        descend = ~accept & ~leaf
+
+        # well-separated nodes act through their center of mass
+        if accept.any():
+            f = fish[accept]
+            e = r_com[accept] / d_com[accept,None]
+            seen = _visible(e, directions[f], _per_fish(angle_of_perception, f))
+            f, c = f[seen], counts[accept][seen]
+            d_a += _scatter_add(f, e[seen] * c[:,None], N)
+            n_a += np.bincount(f, weights=c, minlength=N).astype(int)
+
+        # small nodes are evaluated exactly
+        if leaf.any():
+            c = counts[leaf]
+            f = np.repeat(fish[leaf], c)
+            r_o = np.repeat(_per_fish(r_o, leaf), c) if np.ndim(r_o) > 0 else r_o
+            r_a = np.repeat(_per_fish(r_a, leaf), c) if np.ndim(r_a) > 0 else r_a
+            first = np.repeat(starts[node[leaf]], c)
+            rank = np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c)
+            other = order[first + rank]
+            r_ij = minimum_image(positions[other] - positions[f], box_lengths, reflect_at_boundary)
+            d = np.linalg.norm(r_ij, axis=1)
+            valid = (other != f) & (d >= r_o) & (d < r_a)
+            f, e = f[valid], r_ij[valid] / d[valid,None]
+            seen = _visible(e, directions[f], _per_fish(angle_of_perception, f))
+            d_a += _scatter_add(f[seen], e[seen], N)
+            n_a += np.bincount(f[seen], minlength=N)
+
+        # all other nodes are opened
+        if descend.any():
+            child_starts = levels[level+1][0]
+            parents = node[descend]
+            lo = np.searchsorted(child_starts, starts[parents])
+            hi = np.searchsorted(child_starts, ends[parents])
+            c = hi - lo
+            fish = np.repeat(fish[descend], c)
+            node = np.repeat(lo, c) + np.arange(c.sum()) - np.repeat(np.cumsum(c) - c, c)
+        else:
+            fish = node = np.zeros(0, dtype=int)
+
+    return d_a, n_a
+
+
+def evaluate_directions(directions,d_r,d_o,d_a,n_r,n_o,n_a,thetatau,sigma):
+    """
+    Decide on the new directions of all fish according to the rules
+    stated in the paper and add noise, as in
+    :meth:`couzinswarm.objects.Fish.evaluate_direction`.
+
+    Random numbers are drawn for the fish in the order of `directions`,
+    i.e. in the same order as in the loop over :class:`couzinswarm.objects.Fish`
+    objects if the fish are in the order of their IDs.
+
+    Parameters
+    ----------
+    directions : numpy.ndarray of shape ``(N, 3)``
+        Current directions of all fish.
+    d_r, d_o, d_a : numpy.ndarray of shape ``(N, 3)``
+        Summed directional influences, see :func:`zone_influences`.
+    n_r, n_o, n_a : numpy.ndarray of shape ``(N,)``
+        Number of fish in each zone, see :func:`zone_influences`.
+    thetatau : float or numpy.ndarray of shape ``(N,)``
+        Maximally allowed angle to rotate by per time step.
+    sigma : float or numpy.ndarray of shape ``(N,)``
+        Standard deviation of the noise to be added to the angles
+        of the evaluated new directions.
+
+    Returns
+    -------
+    new_d : numpy.ndarray of shape ``(N, 3)``
+        Unit vectors of the evaluated new directions.
+    """
+
+    N = directions.shape[0]
+
+    new_d = np.where((n_a > 0)[:,None], d_a, directions)
+    new_d = np.where((n_o > 0)[:,None], d_o, new_d)
+    new_d = np.where(((n_o > 0) & (n_a > 0))[:,None], 0.5*(d_o+d_a), new_d)
+    new_d = np.where((n_r > 0)[:,None], d_r, new_d)
+
+    # get spherical coordinates of directions and add some noise to the angles
+    theta = np.arccos(np.clip(new_d[:,2],-1,1))
+    phi = np.arctan2(new_d[:,0],new_d[:,1])
+    noise = np.random.randn(N,2) * np.reshape(sigma, (-1,1))
+    theta = theta + noise[:,0]
+    phi = phi + noise[:,1]
+
+    below, above = theta < 0, theta > np.pi
+    theta = np.where(below, np.pi + theta, np.where(above, theta - np.pi, theta))
+    phi = np.where(below | above, phi + np.pi, phi)
+
+    st, sp = np.sin(theta), np.sin(phi)
+    ct, cp = np.cos(theta), np.cos(phi)
+    new_d = np.stack((st*sp, st*cp, ct), axis=1)
+    new_d /= np.linalg.norm(new_d, axis=1)[:,None]
+
+    # if the angle between old and new directions is larger than allowed
+    # per step size, rotate the current direction towards the new direction by
+    # the maximum radians per step size
+    angle = np.arccos(np.clip(np.einsum('ij,ij->i', new_d, directions), -1.0, 1.0))
+    rotate = angle > thetatau
+    if np.any(rotate):
+        new_d[rotate] = rotate_all_towards(directions[rotate], new_d[rotate], np.broadcast_to(thetatau, (N,))[rotate])
+
+    return new_d
+
+
+def rotate_all_towards(vi,vf,theta):
+    """
+    Rotate each of the vectors `vi` (shape ``(N, 3)``) towards the
+    corresponding vector in `vf` by the angles `theta`, as in
+    :func:`couzinswarm.tools.rotate_towards`.
+    """
+
+    x = np.cross(vi, vf)
+    norm = np.linalg.norm(x, axis=1)
+    parallel = norm < 1e-15
+    x[~parallel] /= norm[~parallel,None]
+    theta = np.asarray(theta)[:,None]
+    c, s = np.cos(theta), np.sin(theta)
+
+    rotated = vi + s * np.cross(x, vi) + (1-c) * np.cross(x, np.cross(x, vi))
+
+    return np.where(parallel[:,None], vi, rotated)
+
+
+def move(positions,directions,speed,dt,box_lengths,reflect_at_boundary):
+    """
+    Move all fish along their new directions and apply the boundary
+    conditions, as in :meth:`couzinswarm.simulation.Swarm.simulate`.
+
+    Parameters
+    ----------
+    positions : numpy.ndarray of shape ``(N, 3)``
+        Current positions of all fish.
+    directions : numpy.ndarray of shape ``(N, 3)``
+        New directions of all fish.
+    speed : float or numpy.ndarray of shape ``(N,)``
+        Speed of the fish.
+    dt : float
+        Time per step.
+    box_lengths : numpy.ndarray of float
+        Dimensions of the simulation box.
+    reflect_at_boundary : list of bool
+        Boundary conditions of the simulation box.
+
+    Returns
+    -------
+    positions : numpy.ndarray of shape ``(N, 3)``
+        New positions.
+    directions : numpy.ndarray of shape ``(N, 3)``
+        New directions (flipped at reflecting boundaries).
+    """
+
+    dr = np.reshape(speed, (-1,1)) * directions * dt
+    directions = directions.copy()
+    new_r = positions + dr
+
+    for dim in range(3):
+        L = box_lengths[dim]
+        above = new_r[:,dim] > L
+        outside = above | (new_r[:,dim] < 0.0)
+        if not reflect_at_boundary[dim]:
+            dr[:,dim] -= np.where(above, L, np.where(outside, -L, 0.0))
+        else:
+            dr[outside,dim] *= -1
+            directions[outside,dim] *= -1
+
+    return positions + dr, directions
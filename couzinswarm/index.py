@@ -0,0 +1,561 @@
+"""
+Index module
+============
+
+Contains the `TrajectoryIndex` class, a spatio-temporal index over
+a stored trajectory which answers radius, box, and pairwise-encounter
+queries without scanning all positions.
+
+The trajectory is divided into blocks of frames. For every block, the
+index stores the bounding box of each fish's positions within that
+block, and sorts the fish into a grid of cells by the centers of
+their bounding boxes. A query first looks up the cells close to the
+queried region, discards fish whose bounding boxes are too far away,
+and only then reads the positions of the remaining fish, one block at
+a time. Periodic boundaries are respected using the minimum image
+convention.
+
+Example
+-------
+
+>>> r, v = swarm.simulate(10000)
+>>> np.save('run.npy', r)
+>>> index = TrajectoryIndex.for_file('run.npy', box_lengths=swarm.box_lengths)
+>>> fish, frames = index.within_radius([50,50,50], 5, start=1000, stop=2000)
+>>> index.first_encounter(0, 1, swarm.repulsion_radius + swarm.orientation_width)
+"""
+
+import os
+
+import numpy as np
+
+from couzinswarm.metadata import __version__
+from couzinswarm.tools import minimum_image
+from couzinswarm.compression import TrajectoryReader, _MAGIC
+
+
+def _gap(center_a,half_a,center_b,half_b,box_lengths,reflect_at_boundary):
+    """
+    Return the per-dimension distances between axis-aligned boxes
+    given by their centers and half widths (zero where they overlap).
+    """
+    d = minimum_image(center_b - center_a, box_lengths, reflect_at_boundary)
+    return np.maximum(np.abs(d) - half_a - half_b, 0.0)
+
+
+def _cell_size_argument(cell_size):
+    """
+    Return the `cell_size` argument of :class:`TrajectoryIndex` as an
+    array of three floats (NaN if `None`), such that it can be saved
+    and compared.
+    """
+    if cell_size is None:
+        return np.full(3, np.nan)
+    return np.broadcast_to(np.asarray(cell_size, dtype=float), (3,)).copy()
+
+
+class TrajectoryIndex:
+    """A spatio-temporal index over the positions of a trajectory.
+
+    Attributes
+    ----------
+    positions : numpy.ndarray of shape ``(N_fish, N_frames, 3)`` or :class:`couzinswarm.compression.TrajectoryReader`
+        The indexed positions, read whenever a query needs exact positions.
+    box_lengths : numpy.ndarray of float
+        Dimensions of the simulation box.
+    reflect_at_boundary : numpy.ndarray of bool
+        Boundary conditions of the simulation box.
+    number_of_fish : int
+        Number of fish.
+    number_of_frames : int
+        Number of frames.
+    block_length : int or None
+        Number of frames per block, `None` if the blocks of a
+        :class:`couzinswarm.compression.TrajectoryReader` were used.
+    block_starts : numpy.ndarray of int
+        Index of the first frame of each block.
+    lower : numpy.ndarray of shape ``(N_blocks, N_fish, 3)``
+        Lower corners of the fish's bounding boxes in each block.
+    upper : numpy.ndarray of shape ``(N_blocks, N_fish, 3)``
+        Upper corners of the fish's bounding boxes in each block.
+    cell_size : numpy.ndarray of float
+        Side lengths of the grid cells.
+    n_cells : numpy.ndarray of int
+        Number of grid cells per dimension.
+
+    Example
+    -------
+
+    >>> index = TrajectoryIndex(r, box_lengths=[100,100,100], reflect_at_boundary=[True,True,True])
+    >>> fish, frames = index.within_box([0,0,0], [10,10,10])
+    >>> index.save('run.npy.index.npz')
+    """
+
+    def __init__(self,
+                 positions,
+                 box_lengths=[100,100,100],
+                 reflect_at_boundary=[True,True,True],
+                 block_length=100,
+                 cell_size=None,
+                 ):
+        """
+        Build the index of a trajectory.
+
+        Parameters
+        ----------
+        positions : numpy.ndarray of shape ``(N_fish, N_frames, 3)`` or :class:`couzinswarm.compression.TrajectoryReader`
+            Positions of the fish. Memory-mapped arrays are read
+            block by block. If a reader is given, its blocks are used
+            and `block_length` is ignored.
+        box_lengths : list or numpy.ndarray of float, default : [100,100,100]
+            Dimensions of the simulation box.
+        reflect_at_boundary : list of bool, default : [True, True, True]
+            Boundary conditions of the simulation box.
+        block_length : int, default : 100
+            Number of frames per block. Long blocks save memory,
+            short blocks give tighter bounding boxes.
+        cell_size : float or list of float, default : None
+            Minimum side lengths of the grid cells. If `None`, cells are
+            chosen such that most bounding boxes fit into a single cell.
+        """
+
+        self.positions = positions
+        self.box_lengths = np.asarray(box_lengths, dtype=float)
+        self.reflect_at_boundary = np.asarray(reflect_at_boundary, dtype=bool)
+        self.number_of_fish, self.number_of_frames = positions.shape[:2]
+        self._owns_positions = False
+
+        if isinstance(positions, TrajectoryReader):
+            self.block_length = None
+            blocks = positions.iter_blocks()
+        else:
+            self.block_length = int(block_length)
+            blocks = ( (t0, positions[:,t0:t0+block_length,:], None)
+                       for t0 in range(0, self.number_of_frames, block_length) )
+
+        block_starts, lower, upper = [], [], []
+        for t0, r, _ in blocks:
+            r = np.asarray(r, dtype=float)
+            block_starts.append(t0)
+            # single precision, rounded outwards
+            lower.append(np.nextafter(r.min(axis=1).astype(np.float32), np.float32(-np.inf)))
+            upper.append(np.nextafter(r.max(axis=1).astype(np.float32), np.float32(np.inf)))
+
+        self.block_starts = np.array(block_starts, dtype=int)
+        self.lower = np.array(lower).reshape(-1,self.number_of_fish,3)
+        self.upper = np.array(upper).reshape(-1,self.number_of_fish,3)
+
+        self._cell_size_argument = _cell_size_argument(cell_size)
+
+        if cell_size is None:
+            # most bounding boxes should fit into a cell, but there is
+            # no use in having many more cells than fish
+            extent = np.quantile((self.upper - self.lower).reshape(-1,3), 0.9, axis=0) if self.lower.size > 0 else np.zeros(3)
+            cell_size = np.maximum(extent, self.box_lengths / max(1, int(np.ceil(self.number_of_fish**(1/3)))))
+        cell_size = np.maximum(np.broadcast_to(np.asarray(cell_size, dtype=float), (3,)), 1e-12)
+
+        self.n_cells = np.maximum(1, np.floor(self.box_lengths / cell_size)).astype(int)
+        self.cell_size = self.box_lengths / self.n_cells
+
+        self._build_cells()
+
+    def _build_cells(self):
+        """
+        Sort the fish of every block into the grid of cells. Fish whose
+        bounding boxes are larger than a cell go into an extra bucket
+        which is checked by every query.
+        """
+
+        n_blocks = len(self.block_starts)
+        n_total = int(np.prod(self.n_cells))
+
+        center = 0.5 * (self.lower.astype(float) + self.upper)
+        wide = ((self.upper.astype(float) - self.lower) > self.cell_size).any(axis=2)
+
+        cell = np.floor(center / self.cell_size).astype(int)
+        cell = np.where(self.reflect_at_boundary, np.clip(cell, 0, self.n_cells-1), cell % self.n_cells)
+        flat = np.ravel_multi_index(np.moveaxis(cell, 2, 0), self.n_cells)
+        flat[wide] = n_total
+
+        self.order = np.argsort(flat, axis=1, kind='stable').astype(np.int32)
+        self.starts = np.zeros((n_blocks, n_total+2), dtype=np.int32)
+        for k in range(n_blocks):
+            self.starts[k,1:] = np.cumsum(np.bincount(flat[k], minlength=n_total+1))
+
+    def save(self,file):
+        """
+        Save the index (without the positions) to a ``.npz`` file.
+        """
+
+        np.savez(file,
+                 version=__version__,
+                 box_lengths=self.box_lengths,
+                 reflect_at_boundary=self.reflect_at_boundary,
+                 number_of_frames=self.number_of_frames,
+                 block_length=-1 if self.block_length is None else self.block_length,
+                 cell_size_argument=self._cell_size_argument,
+                 block_starts=self.block_starts,
+                 lower=self.lower,
+                 upper=self.upper,
+                 cell_size=self.cell_size,
+                 n_cells=self.n_cells,
+                 order=self.order,
+                 starts=self.starts,
+                 )
+
+    @classmethod
+    def load(cls,file,positions):
+        """
+        Load an index saved with :meth:`save`.
+
+        Parameters
+        ----------
+        file : str or file-like object
+            The saved index.
+        positions : numpy.ndarray of shape ``(N_fish, N_frames, 3)`` or :class:`couzinswarm.compression.TrajectoryReader`
+            The indexed positions.
+
+        Returns
+        -------
+        index : :class:`TrajectoryIndex`
+        """
+
+        index = cls.__new__(cls)
+        index.positions = positions
+        index._owns_positions = False
+
+        with np.load(file) as data:
+            if str(data['version']) != __version__:
+                raise ValueError("index was saved by version %s, this is version %s" % (data['version'], __version__))
+            for name in ['box_lengths', 'reflect_at_boundary', 'block_starts',
+                         'lower', 'upper', 'cell_size', 'n_cells', 'order', 'starts']:
+                setattr(index, name, data[name])
+            index.number_of_frames = int(data['number_of_frames'])
+            block_length = int(data['block_length'])
+            index.block_length = None if block_length < 0 else block_length
+            index._cell_size_argument = data['cell_size_argument']
+
+        index.number_of_fish = index.lower.shape[1]
+
+        if tuple(positions.shape[:2]) != (index.number_of_fish, index.number_of_frames):
+            raise ValueError("index was built for a trajectory of shape %s, got %s" % (
+                             (index.number_of_fish, index.number_of_frames), tuple(positions.shape[:2])))
+
+        return index
+
+    @classmethod
+    def for_file(cls,filename,box_lengths=[100,100,100],reflect_at_boundary=[True,True,True],**kwargs):
+        """
+        Open the index of a trajectory on disk, saved next to it as
+        ``filename + '.index.npz'``. The index is built (and saved) if it
+        does not exist yet, is older than the trajectory, was saved by
+        another version, or was built for a different box, `block_length`
+        or `cell_size`.
+
+        Parameters
+        ----------
+        filename : str
+            Either a compressed trajectory written by
+            :class:`couzinswarm.compression.TrajectoryWriter` or a ``.npy``
+            file of positions, which is memory-mapped.
+        box_lengths : list or numpy.ndarray of float, default : [100,100,100]
+            Dimensions of the simulation box.
+        reflect_at_boundary : list of bool, default : [True, True, True]
+            Boundary conditions of the simulation box.
+        **kwargs
+            Passed on to :class:`TrajectoryIndex` when building the index.
+
+        Returns
+        -------
+        index : :class:`TrajectoryIndex`
+            The index, which closes the trajectory file on :meth:`close`.
+        """
+
+        with open(filename, 'rb') as f:
+            compressed = f.read(len(_MAGIC)) == _MAGIC
+
+        if compressed:
+            positions = TrajectoryReader(filename)
+        else:
+            positions = np.load(filename, mmap_mode='r')
+
+        index_filename = filename + '.index.npz'
+        index = None
+
+        if os.path.exists(index_filename) and os.path.getmtime(index_filename) >= os.path.getmtime(filename):
+            try:
+                index = cls.load(index_filename, positions)
+            except (OSError, KeyError, ValueError):
+                index = None
+            if index is not None and not (np.allclose(index.box_lengths, box_lengths) and \
+                                          np.array_equal(index.reflect_at_boundary, reflect_at_boundary)):
+                index = None
+            # the blocks of compressed trajectories are fixed
+            block_length = None if compressed else int(kwargs.get('block_length', 100))
+            if index is not None and not (index.block_length == block_length and \
+                                          np.array_equal(index._cell_size_argument,
+                                                         _cell_size_argument(kwargs.get('cell_size')),
+                                                         equal_nan=True)):
+                index = None
+
+        if index is None:
+            index = cls(positions, box_lengths, reflect_at_boundary, **kwargs)
+            # write to a temporary file first such that concurrent
+            # readers never see partially written indices
+            tmp_filename = index_filename[:-len('.npz')] + '.%d.tmp.npz' % os.getpid()
+            index.save(tmp_filename)
+            os.replace(tmp_filename, index_filename)
+
+        index._owns_positions = True
+
+        return index
+
+    def close(self):
+        """
+        Close the trajectory file if it was opened by :meth:`for_file`.
+        """
+
+        if self._owns_positions and isinstance(self.positions, TrajectoryReader):
+            self.positions.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _blocks(self,start,stop):
+        """
+        Iterate over all blocks which contain frames in ``[start, stop)``,
+        yielding the block index and the first and last+1 frame
+        of the block within ``[start, stop)``.
+        """
+
+        if stop is None or stop > self.number_of_frames:
+            stop = self.number_of_frames
+        start = max(0, start)
+
+        block_stops = np.append(self.block_starts[1:], self.number_of_frames)
+        first = max(0, np.searchsorted(self.block_starts, start, side='right') - 1)
+        for k in range(first, len(self.block_starts)):
+            if self.block_starts[k] >= stop:
+                break
+            t0, t1 = max(start, self.block_starts[k]), min(stop, block_stops[k])
+            if t0 < t1:
+                yield k, t0, t1
+
+    def _read(self,fish,start,stop):
+        """
+        Return the positions of `fish` (sorted array of indices)
+        in the frames ``[start, stop)``.
+        """
+
+        if isinstance(self.positions, TrajectoryReader):
+            return self.positions.read(start, stop)[0][fish]
+        return np.asarray(self.positions[fish,start:stop,:], dtype=float)
+
+    def _cells(self,center,half):
+        """
+        Return the flat indices of all cells which can contain fish whose
+        bounding boxes overlap the box around `center` with half widths `half`,
+        including the bucket of large bounding boxes.
+        """
+
+        w = self.cell_size
+        center = np.where(self.reflect_at_boundary, center, center % self.box_lengths)
+        lo = np.floor((center - half - w/2) / w).astype(int)
+        hi = np.floor((center + half + w/2) / w).astype(int)
+
+        ranges = []
+        for dim in range(3):
+            n = self.n_cells[dim]
+            if self.reflect_at_boundary[dim]:
+                ranges.append(np.arange(max(0, lo[dim]), min(n-1, hi[dim]) + 1))
+            elif hi[dim] - lo[dim] + 1 >= n:
+                ranges.append(np.arange(n))
+            else:
+                ranges.append(np.arange(lo[dim], hi[dim] + 1) % n)
+
+        grid = np.meshgrid(*ranges, indexing='ij')
+        cells = np.ravel_multi_index([ g.ravel() for g in grid ], self.n_cells)
+
+        return np.append(cells, np.prod(self.n_cells))
+
+    def _candidates(self,k,cells):
+        """
+        Return the sorted indices of the fish in `cells` in block `k`.
+        """
+
+        s = self.starts[k,cells]
+        c = self.starts[k,cells+1] - s
+        total = c.sum()
+        rank = np.arange(total) - np.repeat(np.cumsum(c) - c, c)
+
+        return np.sort(self.order[k, np.repeat(s, c) + rank])
+
+    def _query(self,center,half,radius,start,stop):
+        """
+        Find all fish and frames with positions inside the box around
+        `center` with half widths `half` and, if `radius` is not `None`,
+        within `radius` of `center`.
+        """
+
+        center = np.asarray(center, dtype=float)
+        half = np.asarray(half, dtype=float)
+        cells = self._cells(center, half)
+
+        fish, frames = [], []
+        for k, t0, t1 in self._blocks(start, stop):
+            candidates = self._candidates(k, cells)
+            lower = self.lower[k,candidates].astype(float)
+            upper = self.upper[k,candidates].astype(float)
+            gap = _gap(center, half, 0.5*(lower+upper), 0.5*(upper-lower),
+                       self.box_lengths, self.reflect_at_boundary)
+            if radius is None:
+                close = (gap <= 0).all(axis=1)
+            else:
+                close = np.linalg.norm(gap, axis=1) < radius
+            candidates = candidates[close]
+            if len(candidates) == 0:
+                continue
+
+            r = minimum_image(self._read(candidates, t0, t1) - center, self.box_lengths, self.reflect_at_boundary)
+            if radius is None:
+                inside = ((r >= -half) & (r < half)).all(axis=2)
+            else:
+                inside = np.linalg.norm(r, axis=2) < radius
+            i, t = np.nonzero(inside)
+            fish.append(candidates[i])
+            frames.append(t0 + t)
+
+        if len(fish) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int)
+
+        fish = np.concatenate(fish)
+        frames = np.concatenate(frames)
+        order = np.lexsort((fish, frames))
+
+        return fish[order], frames[order]
+
+    def within_radius(self,point,radius,start=0,stop=None):
+        """
+        Find all fish that were closer than `radius` to `point`.
+
+        Parameters
+        ----------
+        point : list or numpy.ndarray of float
+            The queried point.
+        radius : float
+            The queried radius.
+        start : int, default : 0
+            First frame to consider.
+        stop : int, default : None
+            Frame after the last frame to consider.
+
+        Returns
+        -------
+        fish : numpy.ndarray of int
+            Indices of the fish.
+        frames : numpy.ndarray of int
+            The corresponding frames, sorted.
+        """
+
+        return self._query(point, np.full(3, float(radius)), radius, start, stop)
+
+    def within_box(self,lower,upper,start=0,stop=None):
+        """
+        Find all fish that were inside the box ``[lower, upper)``.
+        In periodic dimensions, the box may extend beyond
+        the simulation box.
+
+        Parameters
+        ----------
+        lower : list or numpy.ndarray of float
+            Lower corner of the queried box.
+        upper : list or numpy.ndarray of float
+            Upper corner of the queried box.
+        start : int, default : 0
+            First frame to consider.
+        stop : int, default : None
+            Frame after the last frame to consider.
+
+        Returns
+        -------
+        fish : numpy.ndarray of int
+            Indices of the fish.
+        frames : numpy.ndarray of int
+            The corresponding frames, sorted.
+        """
+
+        lower = np.asarray(lower, dtype=float)
+        upper = np.asarray(upper, dtype=float)
+
+        return self._query(0.5*(lower+upper), 0.5*(upper-lower), None, start, stop)
+
+    def _encounters(self,i,j,distance,start,stop):
+        """
+        Iterate over the frames (per block) in which
+        fish `i` and `j` were closer than `distance`.
+        """
+
+        lower = self.lower[:,[i,j]].astype(float)
+        upper = self.upper[:,[i,j]].astype(float)
+        center = 0.5 * (lower + upper)
+        half = 0.5 * (upper - lower)
+        gap = _gap(center[:,0], half[:,0], center[:,1], half[:,1], self.box_lengths, self.reflect_at_boundary)
+        possible = np.linalg.norm(gap, axis=1) < distance
+
+        fish = np.array([i,j]) if i < j else np.array([j,i])
+        for k, t0, t1 in self._blocks(start, stop):
+            if not possible[k]:
+                continue
+            r = self._read(fish, t0, t1)
+            r_ij = minimum_image(r[1] - r[0], self.box_lengths, self.reflect_at_boundary)
+            yield t0 + np.nonzero(np.linalg.norm(r_ij, axis=1) < distance)[0]
+
+    def encounters(self,i,j,distance,start=0,stop=None):
+        """
+        Find all frames in which fish `i` and `j` were closer than `distance`.
+
+        Parameters
+        ----------
+        i : int
+            Index of the first fish.
+        j : int
+            Index of the second fish.
+        distance : float
+            Encounter distance, e.g. the radius of the zone of orientation
+            (``repulsion_radius + orientation_width``).
+        start : int, default : 0
+            First frame to consider.
+        stop : int, default : None
+            Frame after the last frame to consider.
+
+        Returns
+        -------
+        frames : numpy.ndarray of int
+            The frames, sorted.
+        """
+
+        frames = list(self._encounters(i, j, distance, start, stop))
+        if len(frames) == 0:
+            return np.zeros(0, dtype=int)
+
+        return np.concatenate(frames)
+
+    def first_encounter(self,i,j,distance,start=0,stop=None):
+        """
+        Find the first frame in which fish `i` and `j` were closer than `distance`.
+        Same parameters as :meth:`encounters`.
+
+        Returns
+        -------
+        frame : int or None
+            The first frame, or `None` if the fish never met.
+        """
+
+        for frames in self._encounters(i, j, distance, start, stop):
+            if len(frames) > 0:
+                return int(frames[0])
+
+        return None
@@ -0,0 +1,481 @@
+"""
+Initial conditions module
+=========================
+
+Contains functions generating positions and directions of many fish
+at once, to be used with :meth:`couzinswarm.simulation.Swarm.set_state`.
+
+Each generator returns a tuple ``(positions, directions)`` of arrays
+of shape ``(number_of_fish, 3)``. Generators with a ``min_distance``
+argument redraw fish until no two fish are closer than ``min_distance``
+(e.g. the repulsion radius), using a grid of cells to find close pairs.
+Regions that cannot hold that many fish are rejected right away.
+
+Example
+-------
+
+>>> swarm = Swarm(number_of_fish=100000, engine='neighbor_list')
+>>> swarm.set_state(*ball(100000, center=[50,50,50], radius=30, min_distance=swarm.repulsion_radius))
+"""
+
+import numpy as np
+
+from couzinswarm.tools import minimum_image
+
+
+def random_directions(number_of_fish):
+    """
+    Return `number_of_fish` unit vectors drawn uniformly from the sphere.
+    """
+
+    v = np.random.randn(number_of_fish,3)
+    v /= np.linalg.norm(v,axis=1)[:,None]
+
+    return v
+
+
+# random sequential addition gets stuck at packing fractions of about 0.38
+_MAX_PACKING_FRACTION = 0.3
+
+# maximum number of cells of a dense occupancy grid
+_MAX_DENSE_CELLS = 2**26
+
+
+def _remove_overlaps(positions,
+                     sample,
+                     min_distance,
+                     lower,
+                     upper,
+                     volume,
+                     periodic=[False,False,False],
+                     max_iterations=10000,
+                     ):
+    """
+    Redraw fish using `sample(n)` until no two fish are closer
+    than `min_distance`. All positions have to lie within the box
+    ``[lower, upper]`` of volume at least `volume`, distances in
+    `periodic` dimensions use the minimum image convention.
+
+    Fish are kept in a grid of cells small enough to hold a single
+    fish each, padded with periodic images, such that the neighbors
+    of a fish are found by looking up a fixed set of cells. In every
+    pass, only the fish redrawn in the previous pass are checked.
+    """
+
+    N = len(positions)
+    if min_distance is None or min_distance <= 0 or N < 2:
+        return positions
+
+    packing_fraction = N * np.pi / 6 * min_distance**3 / volume
+    if packing_fraction > _MAX_PACKING_FRACTION:
+        raise ValueError("Cannot place {} fish with `min_distance` {} in a volume of {}, ".format(N, min_distance, volume)+\
+                         "the packing fraction {:.3g} exceeds {}".format(packing_fraction, _MAX_PACKING_FRACTION))
+
+    lower = np.asarray(lower, dtype=float)
+    extent = np.asarray(upper, dtype=float) - lower
+    periodic = np.asarray(periodic, dtype=bool)
+    reflect = ~periodic
+
+    # cells with a diagonal of at most `min_distance`, padded by
+    # as many cells as a neighbor can be away
+    n_cells = np.maximum(1, np.ceil(extent * np.sqrt(3) / min_distance)).astype(int)
+    side = np.where(extent > 0, extent, 1.0) / n_cells
+    reach = np.ceil(min_distance / side).astype(int)
+    shape = n_cells + 2 * reach
+    strides = np.array([shape[1]*shape[2], shape[2], 1])
+
+    # offsets of all other cells that can contain fish closer than `min_distance`
+    grid = np.stack(np.meshgrid(*[ np.arange(-k, k+1) for k in reach ], indexing='ij'), axis=-1).reshape(-1,3)
+    gaps = np.maximum(np.abs(grid) - 1, 0) * side
+    offsets = grid[np.linalg.norm(gaps, axis=1) < min_distance] @ strides
+    offsets = offsets[offsets != 0]
+
+    # periodic images of cells within the padding
+    shifts = []
+    for dim in range(3):
+        K = int(np.ceil(reach[dim] / n_cells[dim])) if periodic[dim] else 0
+        shifts.append(np.arange(-K, K+1) * n_cells[dim])
+    shifts = np.stack(np.meshgrid(*shifts, indexing='ij'), axis=-1).reshape(-1,3)
+
+    # occupancy of the cells, dense if it fits into memory
+    dense = np.prod(shape.astype(float)) <= _MAX_DENSE_CELLS
+    if dense:
+        occupancy = np.full(int(np.prod(shape)), -1, dtype=np.int32)
+    else:
+        keys = np.zeros(0, dtype=np.int64)
+        owners = np.zeros(0, dtype=np.int64)
+
+    def cells_of(r):
+        c = np.floor((r - lower) / side).astype(np.int64)
+        c = np.where(periodic, c % n_cells, np.clip(c, 0, n_cells-1))
+        return c + reach
+
+    def lookup(flat):
+        if dense:
+            return occupancy[flat]
+        elif len(keys) == 0:
+            return np.full(flat.shape, -1, dtype=np.int64)
+        k = np.minimum(np.searchsorted(keys, flat), len(keys)-1)
+        return np.where(keys[k] == flat, owners[k], -1)
+
+    def write(c, fish, remove=False):
+        nonlocal keys, owners
+        flat = []
+        for shift in shifts:
+            image = c + shift
+            valid = ((image >= 0) & (image < shape)).all(axis=1)
+            flat.append((image[valid] @ strides, fish[valid]))
+        flat, fish = np.concatenate([ f for f, _ in flat ]), np.concatenate([ i for _, i in flat ])
+        if dense:
+            occupancy[flat] = -1 if remove else fish
+        elif remove:
+            keep = ~np.isin(keys, flat)
+            keys, owners = keys[keep], owners[keep]
+        else:
+            keys = np.concatenate((keys, flat))
+            owners = np.concatenate((owners, fish))
+            order = np.argsort(keys, kind='stable')
+            keys, owners = keys[order], owners[order]
+
+    is_candidate = np.ones(N, dtype=bool)
+    candidates = np.arange(N)
+    for iteration in range(max_iterations):
+
+        r = positions[candidates]
+        c = cells_of(r)
+        flat = c @ strides
+
+        # cells can only hold one fish, so candidates whose cell is occupied
+        # are rejected, and so is all but the first candidate per cell
+        rejected = lookup(flat) >= 0
+        _, first = np.unique(np.where(rejected, -1, flat), return_index=True)
+        duplicate = np.ones(len(candidates), dtype=bool)
+        duplicate[first] = False
+        rejected |= duplicate
+
+        # insert the remaining candidates (sorted by cell for faster lookups)
+        # and look up their neighbors. In the first pass, all fish are
+        # candidates and it suffices to find each pair from one side
+        k = first[~rejected[first]]
+        write(c[k], candidates[k])
+
+        focal, other = [], []
+        base = flat[k].astype(np.int32) if dense else flat[k]
+        for offset in (offsets[offsets > 0] if iteration == 0 else offsets):
+            neighbor = lookup(base + offset)
+            hit = np.nonzero(neighbor >= 0)[0]
+            focal.append(hit)
+            other.append(neighbor[hit])
+        focal = np.concatenate(focal)
+        other = np.concatenate(other)
+
+        r_ij = minimum_image(positions[other] - r[k[focal]], extent, reflect)
+        close = np.linalg.norm(r_ij, axis=1) < min_distance
+        fish = candidates[k[focal[close]]]
+        other = other[close]
+
+        # a candidate close to an accepted fish is rejected, of two
+        # close candidates the one with the larger index is rejected
+        loser = np.where(is_candidate[other], np.maximum(fish, other), fish)
+        conflicting = np.zeros(N, dtype=bool)
+        conflicting[loser] = True
+        conflicting = conflicting[candidates[k]]
+
+        write(c[k[conflicting]], candidates[k[conflicting]], remove=True)
+        rejected[k[conflicting]] = True
+
+        is_candidate[candidates[~rejected]] = False
+        candidates = candidates[rejected]
+        if len(candidates) == 0:
+            return positions
+
+        positions[candidates] = sample(len(candidates))
+
+    raise ValueError("Could not place fish without overlaps after {} iterations, ".format(max_iterations)+\
+                     "the region is probably too small for `min_distance`")
+
+
+def uniform_box(number_of_fish,box_lengths=[100,100,100],min_distance=None,reflect_at_boundary=[True,True,True]):
+    """
+    Fish at uniformly distributed positions in the whole box
+    with random directions.
+
+    Parameters
+    ----------
+    number_of_fish : int
+        The number of fish.
+    box_lengths : list or numpy.ndarray of float, default : [100,100,100]
+        Dimensions of the simulation box.
+    min_distance : float, default : None
+        Minimum distance between any two fish.
+    reflect_at_boundary : list of bool, default : [True, True, True]
+        Boundary conditions of the simulation box. In periodic
+        dimensions, `min_distance` also holds across the boundary.
+
+    Returns
+    -------
+    positions : numpy.ndarray of shape ``(number_of_fish, 3)``
+    directions : numpy.ndarray of shape ``(number_of_fish, 3)``
+    """
+
+    box_lengths = np.asarray(box_lengths, dtype=float)
+    sample = lambda n: box_lengths * np.random.random((n,3))
+    positions = _remove_overlaps(sample(number_of_fish), sample, min_distance,
+                                 lower=np.zeros(3),
+                                 upper=box_lengths,
+                                 volume=np.prod(box_lengths),
+                                 periodic=~np.asarray(reflect_at_boundary, dtype=bool),
+                                 )
+
+    return positions, random_directions(number_of_fish)
+
+
+def _sample_ball(n,center,radius):
+    """
+    Return `n` points uniformly distributed within a ball.
+    """
+
+    v = np.random.randn(n,3)
+    v /= np.linalg.norm(v,axis=1)[:,None]
+    r = radius * np.random.random(n)**(1/3)
+
+    return center + r[:,None] * v
+
+
+def ball(number_of_fish,center=[50,50,50],radius=10,min_distance=None):
+    """
+    Fish at uniformly distributed positions within a ball
+    with random directions.
+
+    Parameters
+    ----------
+    number_of_fish : int
+        The number of fish.
+    center : list or numpy.ndarray of float, default : [50,50,50]
+        Center of the ball.
+    radius : float, default : 10
+        Radius of the ball.
+    min_distance : float, default : None
+        Minimum distance between any two fish.
+
+    Returns
+    -------
+    positions : numpy.ndarray of shape ``(number_of_fish, 3)``
+    directions : numpy.ndarray of shape ``(number_of_fish, 3)``
+    """
+
+    center = np.asarray(center, dtype=float)
+    sample = lambda n: _sample_ball(n, center, radius)
+    positions = _remove_overlaps(sample(number_of_fish), sample, min_distance,
+                                 lower=center - radius,
+                                 upper=center + radius,
+                                 volume=4/3 * np.pi * radius**3,
+                                 )
+
+    return positions, random_directions(number_of_fish)
+
+
+def slab(number_of_fish,
+         box_lengths=[100,100,100],
+         thickness=10,
+         axis=2,
+         center=None,
+         min_distance=None,
+         reflect_at_boundary=[True,True,True],
+         ):
+    """
+    Fish at uniformly distributed positions within a slab spanning
+    the box perpendicular to `axis`, with random directions.
+
+    Parameters
+    ----------
+    number_of_fish : int
+        The number of fish.
+    box_lengths : list or numpy.ndarray of float, default : [100,100,100]
+        Dimensions of the simulation box.
+    thickness : float, default : 10
+        Thickness of the slab.
+    axis : int, default : 2
+        Dimension perpendicular to the slab.
+    center : float, default : None
+        Position of the slab's center along `axis`.
+        If `None`, the slab is centered in the box.
+    min_distance : float, default : None
+        Minimum distance between any two fish.
+    reflect_at_boundary : list of bool, default : [True, True, True]
+        Boundary conditions of the simulation box. In periodic
+        dimensions spanned by the slab, `min_distance` also
+        holds across the boundary.
+
+    Returns
+    -------
+    positions : numpy.ndarray of shape ``(number_of_fish, 3)``
+    directions : numpy.ndarray of shape ``(number_of_fish, 3)``
+    """
+
+    box_lengths = np.asarray(box_lengths, dtype=float)
+    if center is None:
+        center = box_lengths[axis] / 2
+
+    lo = np.zeros(3)
+    extent = box_lengths.copy()
+    lo[axis] = center - thickness / 2
+    extent[axis] = thickness
+
+    periodic = ~np.asarray(reflect_at_boundary, dtype=bool)
+    periodic[axis] = False
+
+    sample = lambda n: lo + extent * np.random.random((n,3))
+    positions = _remove_overlaps(sample(number_of_fish), sample, min_distance,
+                                 lower=lo,
+                                 upper=lo + extent,
+                                 volume=np.prod(extent),
+                                 periodic=periodic,
+                                 )
+
+    return positions, random_directions(number_of_fish)
+
+
+def polarized(number_of_fish,center=[50,50,50],radius=10,direction=[1,0,0],angular_noise=0.1,min_distance=None):
+    """
+    A polarized school, i.e. fish at uniformly distributed positions
+    within a ball, all swimming in roughly the same direction.
+
+    Parameters
+    ----------
+    number_of_fish : int
+        The number of fish.
+    center : list or numpy.ndarray of float, default : [50,50,50]
+        Center of the school.
+    radius : float, default : 10
+        Radius of the school.
+    direction : list or numpy.ndarray of float, default : [1,0,0]
+        Mean direction of the school.
+    angular_noise : float, default : 0.1
+        Standard deviation of the fish's deviation from the mean
+        direction (unit: radians, roughly).
+    min_distance : float, default : None
+        Minimum distance between any two fish.
+
+    Returns
+    -------
+    positions : numpy.ndarray of shape ``(number_of_fish, 3)``
+    directions : numpy.ndarray of shape ``(number_of_fish, 3)``
+    """
+
+    positions, _ = ball(number_of_fish, center, radius, min_distance)
+
+    direction = np.asarray(direction, dtype=float)
+    direction /= np.linalg.norm(direction)
+    directions = direction + angular_noise * np.random.randn(number_of_fish,3)
+    directions /= np.linalg.norm(directions,axis=1)[:,None]
+
+    return positions, directions
+
+
+def mill(number_of_fish,
+         center=[50,50,50],
+         inner_radius=5,
+         outer_radius=15,
+         height=5,
+         axis=[0,0,1],
+         angular_noise=0.0,
+         min_distance=None,
+         ):
+    """
+    A pre-formed mill (torus), i.e. fish in a hollow cylinder
+    around `axis`, all circling in the same sense.
+
+    Parameters
+    ----------
+    number_of_fish : int
+        The number of fish.
+    center : list or numpy.ndarray of float, default : [50,50,50]
+        Center of the mill.
+    inner_radius : float, default : 5
+        Inner radius of the hollow cylinder.
+    outer_radius : float, default : 15
+        Outer radius of the hollow cylinder.
+    height : float, default : 5
+        Height of the hollow cylinder.
+    axis : list or numpy.ndarray of float, default : [0,0,1]
+        Axis of rotation. Fish circle counter-clockwise around it.
+    angular_noise : float, default : 0.0
+        Standard deviation of the fish's deviation from
+        the tangential direction (unit: radians, roughly).
+    min_distance : float, default : None
+        Minimum distance between any two fish.
+
+    Returns
+    -------
+    positions : numpy.ndarray of shape ``(number_of_fish, 3)``
+    directions : numpy.ndarray of shape ``(number_of_fish, 3)``
+    """
+
+    center = np.asarray(center, dtype=float)
+    axis = np.asarray(axis, dtype=float)
+    axis /= np.linalg.norm(axis)
+
+    # orthonormal basis of the plane perpendicular to the axis
+    e1 = np.cross(axis, [1.,0,0] if abs(axis[0]) < 0.9 else [0,1.,0])
+    e1 /= np.linalg.norm(e1)
+    e2 = np.cross(axis, e1)
+
+    def sample(n):
+        # uniform in the area of the annulus
+        r = np.sqrt(inner_radius**2 + (outer_radius**2 - inner_radius**2) * np.random.random(n))
+        phi = 2 * np.pi * np.random.random(n)
+        z = height * (np.random.random(n) - 0.5)
+        return center + (r*np.cos(phi))[:,None] * e1 + (r*np.sin(phi))[:,None] * e2 + z[:,None] * axis
+
+    # the hollow cylinder lies within a cube around its center
+    half = np.sqrt(outer_radius**2 + (height/2)**2)
+    positions = _remove_overlaps(sample(number_of_fish), sample, min_distance,
+                                 lower=center - half,
+                                 upper=center + half,
+                                 volume=np.pi * (outer_radius**2 - inner_radius**2) * height,
+                                 )
+
+    radial = positions - center
+    radial -= (radial @ axis)[:,None] * axis
+    directions = np.cross(axis, radial)
+    directions /= np.linalg.norm(directions,axis=1)[:,None]
+    directions += angular_noise * np.random.randn(number_of_fish,3)
+    directions /= np.linalg.norm(directions,axis=1)[:,None]
+
+    return positions, directions
+
+
+def lattice(number_of_fish,center=[50,50,50],spacing=1.0,direction=None):
+    """
+    Fish on a simple cubic lattice, filling the smallest cube
+    that contains at least `number_of_fish` sites.
+
+    Parameters
+    ----------
+    number_of_fish : int
+        The number of fish.
+    center : list or numpy.ndarray of float, default : [50,50,50]
+        Center of the lattice.
+    spacing : float, default : 1.0
+        Lattice constant, i.e. the minimum distance between any two fish.
+    direction : list or numpy.ndarray of float, default : None
+        Direction of all fish. If `None`, directions are random.
+
+    Returns
+    -------
+    positions : numpy.ndarray of shape ``(number_of_fish, 3)``
+    directions : numpy.ndarray of shape ``(number_of_fish, 3)``
+    """
+
+    n = int(np.ceil(number_of_fish**(1/3) - 1e-9))
+    sites = np.stack(np.unravel_index(np.arange(number_of_fish), (n,n,n)), axis=1)
+    positions = np.asarray(center, dtype=float) + spacing * (sites - (n-1)/2)
+
+    if direction is None:
+        directions = random_directions(number_of_fish)
+    else:
+        direction = np.asarray(direction, dtype=float)
+        directions = np.tile(direction / np.linalg.norm(direction), (number_of_fish,1))
+
+    return positions, directions
@@ -3,7 +3,7 @@
 Contains a bunch of information about this package.
 """
 
-__version__ = "0.0.3"
+__version__ = "0.0.4"
 
 __author__ = "Benjamin F. Maier"
 __copyright__ = "Copyright 2019, Benjamin F. Maier"
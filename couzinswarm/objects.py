@@ -115,7 +115,7 @@ class Fish:
             unit vector pointing to the other fish
         """
 
-        self.d_a += self.d_a + r_ij
+        self.d_a = self.d_a + r_ij
         self.n_a += 1
 
     def evaluate_direction(self,thetatau,sigma):
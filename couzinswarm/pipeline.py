@@ -0,0 +1,331 @@
+"""
+Pipeline module
+===============
+
+Contains the `Pipeline` class, which runs consumers of simulation
+frames (writers, observables, ...) in separate processes while
+the simulation is running.
+
+Frames are passed through a ring buffer in shared memory. Every
+consumer reads the frames directly from this buffer without copying.
+If a consumer falls behind by more than ``queue_depth`` frames,
+the simulation waits for it.
+"""
+
+import pickle
+import queue
+import multiprocessing as mp
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from couzinswarm.compression import TrajectoryWriter
+
+
+class Consumer:
+    """Base class of consumers of simulation frames.
+
+    Consumers are run in a separate process. Hence, all results
+    have to be returned by :meth:`finalize`, changes to the
+    consumer's attributes are not visible in the parent process.
+    """
+
+    def consume(self,t,positions,directions):
+        """
+        Process a single frame.
+
+        Parameters
+        ----------
+        t : int
+            Time step of this frame.
+        positions : numpy.ndarray of shape ``(N_fish, 3)``
+            Positions of the fish. This is a view into shared memory
+            which is only valid until this method returns.
+        directions : numpy.ndarray of shape ``(N_fish, 3)``
+            Directions of the fish. This is a view into shared memory
+            which is only valid until this method returns.
+        """
+        raise NotImplementedError
+
+    def finalize(self):
+        """
+        Called after the last frame. The return value is sent
+        back to the parent process.
+        """
+        return None
+
+
+class TrajectoryFileConsumer(Consumer):
+    """Write all frames to a compressed trajectory file.
+
+    Parameters
+    ----------
+    filename : str
+        File to write to.
+    **kwargs
+        Passed on to :class:`couzinswarm.compression.TrajectoryWriter`.
+    """
+
+    def __init__(self,filename,**kwargs):
+        self.filename = filename
+        self.kwargs = kwargs
+        self.writer = None
+
+    def consume(self,t,positions,directions):
+        if self.writer is None:
+            self.writer = TrajectoryWriter(self.filename, positions.shape[0], **self.kwargs)
+        self.writer.append(positions, directions)
+
+    def finalize(self):
+        if self.writer is not None:
+            self.writer.close()
+            return self.writer.number_of_frames
+        return 0
+
+
+class OrderParameterConsumer(Consumer):
+    """Compute the group polarization and the group angular momentum
+    of every frame, as defined in the paper.
+
+    :meth:`finalize` returns the time steps and both order parameters
+    as arrays.
+    """
+
+    def __init__(self):
+        self.t = []
+        self.polarization = []
+        self.angular_momentum = []
+
+    def consume(self,t,positions,directions):
+        center = positions.mean(axis=0)
+        r_ic = positions - center
+        r_ic /= np.linalg.norm(r_ic,axis=1)[:,None]
+        self.t.append(t)
+        self.polarization.append(np.linalg.norm(directions.mean(axis=0)))
+        self.angular_momentum.append(np.linalg.norm(np.cross(r_ic,directions).mean(axis=0)))
+
+    def finalize(self):
+        return np.array(self.t), np.array(self.polarization), np.array(self.angular_momentum)
+
+
+def _consumer_loop(k,consumer,shm_name,n_slots,number_of_fish,filled,free,results):
+    """
+    Run a consumer on frames from the ring buffer until the
+    end-of-simulation sentinel is found.
+    """
+
+    shm = shared_memory.SharedMemory(name=shm_name)
+    frames, times = _buffer_views(shm, n_slots, number_of_fish)
+
+    error = None
+    slot = 0
+    try:
+        while True:
+            filled.acquire()
+            t = int(times[slot])
+            if t < 0:
+                break
+            # after an error keep releasing slots such that
+            # the simulation does not wait for this consumer forever
+            if error is None:
+                try:
+                    consumer.consume(t, frames[slot,0], frames[slot,1])
+                except Exception as e:
+                    error = e
+            free.release()
+            slot = (slot + 1) % n_slots
+
+        # pickle the result here, such that errors are reported (the
+        # queue would silently drop objects that cannot be pickled)
+        if error is None:
+            try:
+                results.put((k, True, pickle.dumps(consumer.finalize())))
+            except Exception as e:
+                error = e
+        if error is not None:
+            results.put((k, False, repr(error)))
+    finally:
+        del frames, times
+        shm.close()
+
+
+def _collect(results,processes,timeout=1.0):
+    """
+    Collect one result per consumer process from the `results` queue,
+    checking regularly whether the processes are still alive.
+    """
+
+    collected = {}
+    while len(collected) < len(processes):
+        try:
+            k, success, value = results.get(timeout=timeout)
+            collected[k] = (success, value)
+            continue
+        except queue.Empty:
+            pass
+
+        for k, p in enumerate(processes):
+            if k in collected or p.is_alive():
+                continue
+            # a process that has put its result can exit
+            # before the result arrives, so wait once more
+            try:
+                while True:
+                    j, success, value = results.get(timeout=timeout)
+                    collected[j] = (success, value)
+            except queue.Empty:
+                pass
+            if k not in collected:
+                raise RuntimeError("consumer %d exited unexpectedly (exit code %s)" % (k, p.exitcode))
+
+    return collected
+
+
+def _buffer_views(shm,n_slots,number_of_fish):
+    """
+    Return the frame array of shape ``(n_slots, 2, number_of_fish, 3)``
+    and the time step array of shape ``(n_slots,)`` living in `shm`.
+    """
+
+    frames = np.ndarray((n_slots,2,number_of_fish,3), dtype=float, buffer=shm.buf)
+    times = np.ndarray((n_slots,), dtype=np.int64, buffer=shm.buf, offset=frames.nbytes)
+
+    return frames, times
+
+
+class Pipeline:
+    """Run a simulation while consumers process its frames concurrently.
+
+    Every consumer runs in its own process. The simulation writes each
+    frame into the next slot of a ring buffer in shared memory and
+    continues as soon as this slot has been released by all consumers,
+    i.e. consumers can fall behind by at most ``queue_depth`` frames.
+
+    Attributes
+    ----------
+    consumers : list of :class:`Consumer`
+        The consumers to be run. If processes are started with the ``spawn``
+        method, consumers have to be picklable.
+    queue_depth : int
+        Number of slots in the ring buffer.
+
+    Example
+    -------
+
+    >>> pipeline = Pipeline([TrajectoryFileConsumer('run.czt'), OrderParameterConsumer()])
+    >>> r, v, (n_frames, (t, p, m)) = pipeline.run(swarm, 1000)
+    """
+
+    def __init__(self,consumers,queue_depth=16,context=None):
+        """
+        Parameters
+        ----------
+        consumers : list of :class:`Consumer`
+            The consumers to be run.
+        queue_depth : int, default : 16
+            Number of slots in the ring buffer.
+        context : multiprocessing context, default : None
+            Context used to start processes. If `None`, the default
+            context is used.
+        """
+
+        if queue_depth < 1:
+            raise ValueError("`queue_depth` has to be at least 1")
+
+        self.consumers = list(consumers)
+        self.queue_depth = int(queue_depth)
+        self.context = mp.get_context() if context is None else context
+
+    def run(self,swarm,N_time_steps,**kwargs):
+        """
+        Simulate `swarm` for `N_time_steps` while all
+        consumers process the frames.
+
+        Parameters
+        ----------
+        swarm : :class:`couzinswarm.simulation.Swarm`
+            The swarm to be simulated.
+        N_time_steps : int
+            Number of time steps to simulate.
+        **kwargs
+            Passed on to :meth:`couzinswarm.simulation.Swarm.simulate`.
+
+        Returns
+        -------
+        positions : numpy.ndarray of shape ``(N_fish, N_time_steps+1, 3)``
+        directions : numpy.ndarray of shape ``(N_fish, N_time_steps+1, 3)``
+        results : list
+            The return values of each consumer's :meth:`Consumer.finalize`.
+        """
+
+        ctx = self.context
+        N = swarm.number_of_fish
+        n_slots = self.queue_depth
+        nbytes = n_slots * 2 * N * 3 * 8 + n_slots * 8
+
+        shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        frames, times = _buffer_views(shm, n_slots, N)
+
+        filled = [ ctx.Semaphore(0) for _ in self.consumers ]
+        free = [ ctx.Semaphore(n_slots) for _ in self.consumers ]
+        results = ctx.Queue()
+
+        processes = [ ctx.Process(target=_consumer_loop,
+                                  args=(k, consumer, shm.name, n_slots, N, filled[k], free[k], results),
+                                  daemon=True,
+                                  )
+                      for k, consumer in enumerate(self.consumers) ]
+
+        # the buffer views live in `state` such that they
+        # can be released before the shared memory is closed
+        state = {'slot': 0, 'frames': frames, 'times': times}
+        del frames, times
+
+        def publish(t, positions, directions):
+            slot = state['slot']
+            frames, times = state['frames'], state['times']
+            # wait until every consumer has released this slot
+            for k, sem in enumerate(free):
+                while not sem.acquire(timeout=1.0):
+                    if not processes[k].is_alive():
+                        raise RuntimeError("consumer %d exited unexpectedly" % k)
+            if t >= 0:
+                frames[slot,0] = positions
+                frames[slot,1] = directions
+            times[slot] = t
+            for sem in filled:
+                sem.release()
+            state['slot'] = (slot + 1) % n_slots
+
+        try:
+            for p in processes:
+                p.start()
+
+            try:
+                positions, directions = swarm.simulate(N_time_steps, callback=publish, **kwargs)
+            except BaseException:
+                for p in processes:
+                    p.terminate()
+                raise
+
+            # send the end-of-simulation sentinel
+            publish(-1, None, None)
+
+            collected = _collect(results, processes)
+            for p in processes:
+                p.join()
+        finally:
+            for p in processes:
+                if p.is_alive():
+                    p.terminate()
+            state.clear()
+            shm.close()
+            shm.unlink()
+
+        finalized = [None] * len(self.consumers)
+        for k, (success, value) in collected.items():
+            if not success:
+                raise RuntimeError("consumer %d failed: %s" % (k, value))
+            finalized[k] = pickle.loads(value)
+
+        return positions, directions, finalized
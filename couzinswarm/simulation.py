@@ -7,11 +7,31 @@ Contains the `Swarm` class, which is used for simulation.
 import numpy as np
 
 from couzinswarm.objects import Fish
+from couzinswarm.tools import neighbor_pairs, all_pairs, morton_codes
+from couzinswarm.engine import zone_influences, octree_attraction, evaluate_directions, move
+from couzinswarm.initial_conditions import uniform_box
 
 from progressbar import ProgressBar as PB
 
+# parameters that can be given per fish
+_FISH_PARAMETERS = [
+        'repulsion_radius',
+        'orientation_width',
+        'attraction_width',
+        'angle_of_perception',
+        'turning_rate',
+        'speed',
+        'noise_sigma',
+    ]
+
 class Swarm:
     """A class for a swarm simulation.
+
+    The behavioral parameters `repulsion_radius`, `orientation_width`,
+    `attraction_width`, `angle_of_perception`, `turning_rate`, `speed`,
+    and `noise_sigma` can either be a single value for all fish or
+    an array of length `number_of_fish` containing a value per fish.
+    Per-fish values are only supported by the array-based engines.
     
     Attributes
     ----------
@@ -19,28 +39,28 @@ class Swarm:
         The number of fish to be simulated
     fish : list of :mod:`couzinswarm.objects.Fish`
         Contains the `Fish` objects which are simulated in this setup.
-    repulsion_radius : float, default : 1.0
+    repulsion_radius : float or numpy.ndarray, default : 1.0
         Fish within this radius will repel each other
         (unit: length of a single fish).
-    orientation_width : float, default : 10.0
+    orientation_width : float or numpy.ndarray, default : 10.0
         The width of the hollow ball in which fish adjust their
         orientation.
         (unit: length of a single fish).
-    attraction_width : float, default : 10.0
+    attraction_width : float or numpy.ndarray, default : 10.0
         The width of the hollow ball in which fish attract
         each other
         (unit: length of a single fish).
-    angle_of_perception : float, default : 340/360*pi
+    angle_of_perception : float or numpy.ndarray, default : 340/360*pi
         angle in which a fish can see other fish
         (unit: radians, with a maximum value of :math:`\pi`.
-    turning_rate : float, default : 0.1
+    turning_rate : float or numpy.ndarray, default : 0.1
         Rate at which the new direction is approached.
         The maximum angle change per time step is hence ``turning_rate * dt``
         (unit: radians per unit time).
-    speed : float, default : 0.1
+    speed : float or numpy.ndarray, default : 0.1
         Speed of a fish.
         (unit: fish length per unit time).
-    noise_sigma : float, default : 0.01
+    noise_sigma : float or numpy.ndarray, default : 0.01
         Standard deviation of radial noise whith 
         which each direction adjustment is shifted
         (unit: radians).
@@ -57,6 +77,29 @@ class Swarm:
         be chatty.
     show_progress : bool, default : False
         Show the progress of the simulation.
+    engine : str, default : 'loop'
+        How a time step is computed. ``'loop'`` is the reference
+        implementation looping over all pairs of `Fish` objects.
+        ``'vectorized'`` updates all fish at once using array operations on
+        all pairs, ``'neighbor_list'`` does the same but only considers pairs
+        found with a grid of cells, which is faster for large swarms.
+        The array-based engines use the minimum image convention at
+        periodic boundaries (which agrees with ``'loop'`` if the box
+        is at least twice as large as the interaction range).
+    opening_angle : float, default : None
+        If given, influences in the zone of attraction are approximated using
+        an octree, where groups of distant fish whose extent appears under an
+        angle smaller than `opening_angle` (in radians, roughly) are treated as
+        a single point. Only available for the array-based engines.
+    reorder_interval : int, default : 100
+        Every `reorder_interval` steps, the array-based engines sort their
+        internal state along a Morton (Z-order) curve such that fish close
+        in space are close in memory, starting after the first
+        `reorder_interval` steps of each call to :meth:`simulate`. Recorded
+        trajectories and `fish` keep the original order. Until the first
+        reordering, random numbers are assigned to the fish as in the
+        loop engine, afterwards noisy runs only agree statistically.
+        If `None` or zero, the state is never reordered.
 
     """
 
@@ -74,6 +117,9 @@ class Swarm:
                  reflect_at_boundary = [True, True, True],
                  verbose=False,
                  show_progress=False,
+                 engine='loop',
+                 opening_angle=None,
+                 reorder_interval=100,
                  ):
         """
         Setup a simulation with parameters as defined in the paper.
@@ -85,28 +131,28 @@ class Swarm:
         ----------
         number_of_fish : int, default : 20
             The number of fish to be simulated
-        repulsion_radius : float, default : 1.0
+        repulsion_radius : float or numpy.ndarray, default : 1.0
             Fish within this radius will repel each other
             (unit: length of a single fish).
-        orientation_width : float, default : 10.0
+        orientation_width : float or numpy.ndarray, default : 10.0
             The width of the hollow ball in which fish adjust their
             orientation.
             (unit: length of a single fish).
-        attraction_width : float, default : 10.0
+        attraction_width : float or numpy.ndarray, default : 10.0
             The width of the hollow ball in which fish attract
             each other
             (unit: length of a single fish).
-        angle_of_perception : float, default : 340/360*pi
+        angle_of_perception : float or numpy.ndarray, default : 340/360*pi
             angle in which a fish can see other fish
             (unit: radians, with a maximum value of :math:`\pi`.
-        turning_rate : float, default : 0.1
+        turning_rate : float or numpy.ndarray, default : 0.1
             Rate at which the new direction is approached.
             The maximum angle change per time step is hence ``turning_rate * dt``
             (unit: radians per unit time).
-        speed : float, default : 0.1
+        speed : float or numpy.ndarray, default : 0.1
             Speed of a fish.
             (unit: fish length per unit time).
-        noise_sigma : float, default : 0.01
+        noise_sigma : float or numpy.ndarray, default : 0.01
             Standard deviation of radial noise whith 
             which each direction adjustment is shifted
             (unit: radians).
@@ -121,6 +167,18 @@ class Swarm:
             If they don't reflect they're considered to be periodic
         verbose : bool, default : False
             be chatty.
+        show_progress : bool, default : False
+            Show the progress of the simulation.
+        engine : str, default : 'loop'
+            How a time step is computed, one of ``'loop'``,
+            ``'vectorized'``, and ``'neighbor_list'``.
+        opening_angle : float, default : None
+            If given, approximate the influences in the zone of attraction
+            using an octree with this accuracy parameter (smaller is more accurate).
+        reorder_interval : int, default : 100
+            Number of steps after which the array-based engines sort their
+            internal state along a Morton curve (the first time after
+            `reorder_interval` steps). If `None` or zero, never reorder.
 
         """
         
@@ -138,6 +196,22 @@ class Swarm:
         self.reflect_at_boundary = reflect_at_boundary
         self.verbose = verbose
         self.show_progress = show_progress
+        self.engine = engine
+        self.opening_angle = opening_angle
+        self.reorder_interval = reorder_interval
+
+        for name in _FISH_PARAMETERS:
+            value = getattr(self, name)
+            if np.ndim(value) > 0:
+                value = np.array(value, dtype=float)
+                if value.shape != (self.number_of_fish,):
+                    raise ValueError("`{}` has to be a scalar or an array of length `number_of_fish`".format(name))
+                setattr(self, name, value)
+
+        if engine not in ('loop', 'vectorized', 'neighbor_list'):
+            raise ValueError("Unknown engine '{}'".format(engine))
+        if opening_angle is not None and engine == 'loop':
+            raise ValueError("`opening_angle` requires the 'vectorized' or 'neighbor_list' engine")
 
         self.box_copies = [[0.],[0.],[0.]]
 
@@ -146,50 +220,136 @@ class Swarm:
                 self.box_copies[dim].extend([-self.box_lengths[dim],+self.box_lengths[dim]])
 
 
-        self.fish = []
+        self._fish = None
+        self._positions = None
+        self._directions = None
 
         self.init_random()
 
 
     def init_random(self):
         """
-        Initialize the fish list
+        Initialize the fish at uniformly distributed random positions
+        with random directions.
+        """
+
+        self.set_state(*uniform_box(self.number_of_fish, self.box_lengths))
+
+    @property
+    def fish(self):
+        """
+        The list of :class:`couzinswarm.objects.Fish` objects. If the
+        state was set with :meth:`set_state`, the objects are created on
+        first access.
+        """
+
+        if self._fish is None:
+            self._fish = [ Fish(position=r.copy(),
+                                direction=v,
+                                ID=i,
+                                verbose=self.verbose,
+                                ) for i, (r, v) in enumerate(zip(self._positions, self._directions)) ]
+            self._positions = self._directions = None
+
+        return self._fish
+
+    @fish.setter
+    def fish(self,fish):
+        self._fish = list(fish)
+        self._positions = self._directions = None
+
+    def set_state(self,positions,directions):
+        """
+        Set the positions and directions of all fish at once.
+
+        Parameters
+        ----------
+        positions : numpy.ndarray of shape ``(self.number_of_fish, 3)``
+            New positions of the fish.
+        directions : numpy.ndarray of shape ``(self.number_of_fish, 3)``
+            New directions of the fish (will be normalized).
+        """
+
+        positions = np.array(positions, dtype=float)
+        directions = np.array(directions, dtype=float)
+
+        shape = (self.number_of_fish, 3)
+        if positions.shape != shape or directions.shape != shape:
+            raise ValueError("`positions` and `directions` have to be of shape {}".format(shape))
+
+        directions /= np.linalg.norm(directions, axis=1)[:,None]
+
+        self._positions = positions
+        self._directions = directions
+        self._fish = None
+
+    def get_state(self):
+        """
+        Return the current positions and directions of all fish.
+
+        Returns
+        -------
+        positions : numpy.ndarray of shape ``(self.number_of_fish, 3)``
+        directions : numpy.ndarray of shape ``(self.number_of_fish, 3)``
         """
 
-        self.fish = [ Fish(position=self.box_lengths*np.random.random((3,)),
-                           ID=i,
-                           verbose=self.verbose
-                           ) for i in range(self.number_of_fish) ]
+        if self._fish is None:
+            return self._positions.copy(), self._directions.copy()
+
+        positions = np.array([ F.position for F in self._fish ], dtype=float)
+        directions = np.array([ F.direction for F in self._fish ], dtype=float)
 
-    def simulate(self,N_time_steps):
+        return positions, directions
+
+    def simulate(self,N_time_steps,callback=None,record=True):
         """Simulate a swarm according to the rules.
 
         Parameters
         ----------
         N_time_steps : int
             Number of time steps to simulate.
+        callback : callable, default : None
+            If given, will be called as ``callback(t, positions, directions)``
+            with the fish's positions and directions (arrays of shape
+            ``(self.number_of_fish, 3)``) for the initial state (``t = 0``)
+            and after each time step.
+        record : bool, default : True
+            If `False`, only the current frame is held in memory (e.g.
+            for long burn-in phases) and only the final state is returned.
 
         Returns
         -------
         positions : numpy.ndarray of shape ``(self.number_of_fish, N_time_steps+1, 3_)``
-            Keeping track of the fish's positions for each time step.
+            Keeping track of the fish's positions for each time step
+            (of shape ``(self.number_of_fish, 3)`` if `record` is `False`).
         directions : numpy.ndarray of shape ``(self.number_of_fish, N_time_steps+1, 3_)``
-            Keeping track of the fish's directions for each time step.
+            Keeping track of the fish's directions for each time step
+            (of shape ``(self.number_of_fish, 3)`` if `record` is `False`).
         """
 
+        if self.engine != 'loop':
+            return self._simulate_arrays(N_time_steps, callback, record)
+        elif any(np.ndim(getattr(self, name)) > 0 for name in _FISH_PARAMETERS):
+            raise ValueError("Per-fish parameters require the 'vectorized' or 'neighbor_list' engine")
 
-        # create result arrays and fill in initial positions
-        positions = np.empty((self.number_of_fish,N_time_steps+1,3))
-        directions = np.empty((self.number_of_fish,N_time_steps+1,3))
+        # create result arrays and fill in initial positions,
+        # without recording, frame 0 is overwritten in every time step
+        N_frames = N_time_steps+1 if record else 1
+        positions = np.empty((self.number_of_fish,N_frames,3))
+        directions = np.empty((self.number_of_fish,N_frames,3))
         for i in range(self.number_of_fish):
             positions[i,0,:] = self.fish[i].position
             directions[i,0,:] = self.fish[i].direction
-        
+
+        if callback is not None:
+            callback(0, positions[:,0,:], directions[:,0,:])
 
         bar = PB(max_value=N_time_steps)
         # for each time step
         for t in range(1,N_time_steps+1):
 
+            frame = t if record else 0
+
             # iterate through fish pairs
             for i in range(self.number_of_fish-1):
                 F_i = self.fish[i]
@@ -286,11 +446,117 @@ class Swarm:
                 F_i.direction = new_v
 
                 # save position and direction
-                positions[i,t,:] = F_i.position
-                directions[i,t,:] = F_i.direction
+                positions[i,frame,:] = F_i.position
+                directions[i,frame,:] = F_i.direction
+
+            if callback is not None:
+                callback(t, positions[:,frame,:], directions[:,frame,:])
+
+            bar.update(t)
+
+        if not record:
+            return positions[:,0,:], directions[:,0,:]
+
+        return positions, directions
+
+    def _influences(self,r,v,parameters):
+        """
+        Compute the directional influences on all fish
+        at positions `r` with directions `v`, given the
+        (possibly per-fish) behavioral `parameters`.
+        """
+
+        p = parameters
+        r_o = p['repulsion_radius'] + p['orientation_width']
+        r_a = r_o + p['attraction_width']
+        find_pairs = neighbor_pairs if self.engine == 'neighbor_list' else all_pairs
+
+        # if attraction is approximated, only close pairs are needed exactly
+        cutoff = np.max(r_a) if self.opening_angle is None else np.max(r_o)
+        i, j, r_ij, distance = find_pairs(r, cutoff, self.box_lengths, self.reflect_at_boundary)
+
+        d_r, d_o, d_a, n_r, n_o, n_a = zone_influences(r, v, i, j, r_ij, distance,
+                                                       p['repulsion_radius'],
+                                                       p['orientation_width'],
+                                                       p['attraction_width'],
+                                                       p['angle_of_perception'],
+                                                       )
+
+        if self.opening_angle is not None:
+            d_a, n_a = octree_attraction(r, v, r_o, r_a,
+                                         p['angle_of_perception'],
+                                         self.opening_angle,
+                                         self.box_lengths,
+                                         self.reflect_at_boundary,
+                                         )
+
+        return d_r, d_o, d_a, n_r, n_o, n_a
+
+    def _simulate_arrays(self,N_time_steps,callback=None,record=True):
+        """
+        Simulate the swarm updating all fish at once,
+        see :meth:`simulate`.
+        """
+
+        r, v = self.get_state()
+
+        N_frames = N_time_steps+1 if record else 1
+        positions = np.empty((self.number_of_fish,N_frames,3))
+        directions = np.empty((self.number_of_fish,N_frames,3))
+        positions[:,0,:] = r
+        directions[:,0,:] = v
+
+        if callback is not None:
+            callback(0, positions[:,0,:], directions[:,0,:])
+
+        # internal index k holds the fish with ID `permutation[k]`
+        permutation = np.arange(self.number_of_fish)
+        parameters = { name: getattr(self, name) for name in _FISH_PARAMETERS }
+
+        bar = PB(max_value=N_time_steps)
+        for t in range(1,N_time_steps+1):
+
+            # sort the state along a Morton curve such that
+            # fish close in space are close in memory. The initial
+            # order is kept for the first steps such that short runs
+            # draw noise for the fish in the same order as the loop
+            if self.reorder_interval and t > 1 and (t-1) % self.reorder_interval == 0:
+                order = np.argsort(morton_codes(r, self.box_lengths), kind='stable')
+                r, v, permutation = r[order], v[order], permutation[order]
+                parameters = { name: value[order] if np.ndim(value) > 0 else value
+                               for name, value in parameters.items() }
+
+            influences = self._influences(r, v, parameters)
+            new_v = evaluate_directions(v, *influences,
+                                        thetatau=parameters['turning_rate']*self.dt,
+                                        sigma=parameters['noise_sigma'],
+                                        )
+            r, v = move(r, new_v, parameters['speed'], self.dt, self.box_lengths, self.reflect_at_boundary)
+
+            frame = t if record else 0
+            positions[permutation,frame,:] = r
+            directions[permutation,frame,:] = v
+
+            if callback is not None:
+                callback(t, positions[:,frame,:], directions[:,frame,:])
 
             bar.update(t)
 
+        # only update fish objects if they are in use, otherwise keep arrays
+        if self._fish is None:
+            self._positions = np.empty_like(r)
+            self._directions = np.empty_like(v)
+            self._positions[permutation] = r
+            self._directions[permutation] = v
+        else:
+            for k, r_i, v_i in zip(permutation, r, v):
+                F = self._fish[k]
+                F.position = r_i.copy()
+                F.direction = v_i.copy()
+
+        if not record:
+            return positions[:,0,:], directions[:,0,:]
+
         return positions, directions
 
 
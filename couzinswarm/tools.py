@@ -56,7 +56,153 @@ def sphere2cart(theta, phi):
     z = ct
 
     return np.array([x,y,z])
-        
+
+
+def minimum_image(r_ij, box_lengths, reflect_at_boundary):
+    """
+    Return the difference vectors `r_ij` (array of shape ``(..., 3)``),
+    mapped to their closest periodic image in every dimension
+    that does not reflect at the boundary.
+    """
+    r_ij = np.array(r_ij, dtype=float)
+    box_lengths = np.asarray(box_lengths, dtype=float)
+    for dim, reflect in enumerate(reflect_at_boundary):
+        if not reflect:
+            L = box_lengths[dim]
+            r_ij[...,dim] -= L * np.rint(r_ij[...,dim] / L)
+
+    return r_ij
+
+
+def neighbor_pairs(positions, cutoff, box_lengths, reflect_at_boundary, subset=None):
+    """
+    Find all pairs of points in `positions` (array of shape ``(N, 3)``)
+    that are closer than `cutoff` to each other, using a grid of cells
+    with side lengths of at least `cutoff`. Periodic dimensions are
+    treated with the minimum image convention, which requires
+    ``cutoff <= box_length/2`` in these dimensions.
+
+    Returns the index arrays `i` and `j` (with ``i < j``), the
+    difference vectors ``r_j - r_i`` and their norms.
+
+    If an array of indices `subset` is given, only pairs containing
+    at least one of these points are returned, where `i` is
+    always in `subset` (and ``i < j`` only holds if both are).
+    """
+    positions = np.asarray(positions, dtype=float)
+    box_lengths = np.asarray(box_lengths, dtype=float)
+    periodic = ~np.asarray(reflect_at_boundary, dtype=bool)
+    N = positions.shape[0]
+
+    # cells must not be smaller than the cutoff, and there is
+    # no use in having many more cells than points
+    n_cells = np.maximum(1, np.floor(box_lengths / cutoff)).astype(int)
+    n_cells = np.minimum(n_cells, int(2 * N**(1/3)) + 1)
+    cell = np.floor(positions / (box_lengths / n_cells)).astype(int)
+    cell = np.where(periodic, cell % n_cells, np.clip(cell, 0, n_cells-1))
+
+    flat = np.ravel_multi_index(cell.T, n_cells)
+    order = np.argsort(flat, kind='stable')
+    counts = np.bincount(flat, minlength=np.prod(n_cells))
+    starts = np.cumsum(counts) - counts
+
+    if subset is None:
+        sources = np.arange(N)
+    else:
+        sources = np.asarray(subset, dtype=int)
+        in_subset = np.zeros(N, dtype=bool)
+        in_subset[sources] = True
+
+    # neighboring cell offsets per dimension; in periodic dimensions with
+    # less than three cells, several offsets point to the same cell
+    offsets = []
+    for dim in range(3):
+        if periodic[dim]:
+            offsets.append(np.unique(np.array([-1,0,1]) % n_cells[dim]))
+        else:
+            offsets.append(np.array([-1,0,1]) if n_cells[dim] > 1 else np.array([0]))
+
+    I, J = [], []
+    for dx in offsets[0]:
+        for dy in offsets[1]:
+            for dz in offsets[2]:
+                nb = cell[sources] + np.array([dx,dy,dz])
+                valid = np.ones(len(sources), dtype=bool)
+                for dim in range(3):
+                    if periodic[dim]:
+                        nb[:,dim] %= n_cells[dim]
+                    else:
+                        valid &= (nb[:,dim] >= 0) & (nb[:,dim] < n_cells[dim])
+                i = sources[valid]
+                nb_flat = np.ravel_multi_index(nb[valid].T, n_cells)
+                c = counts[nb_flat]
+                total = c.sum()
+                if total == 0:
+                    continue
+                ii = np.repeat(i, c)
+                first = np.repeat(starts[nb_flat], c)
+                rank = np.arange(total) - np.repeat(np.cumsum(c) - c, c)
+                jj = order[first + rank]
+                if subset is None:
+                    keep = ii < jj
+                else:
+                    keep = (ii != jj) & ((ii < jj) | ~in_subset[jj])
+                I.append(ii[keep])
+                J.append(jj[keep])
+
+    if len(I) == 0:
+        i = j = np.zeros(0, dtype=int)
+    else:
+        i = np.concatenate(I)
+        j = np.concatenate(J)
+
+    r_ij = minimum_image(positions[j] - positions[i], box_lengths, ~periodic)
+    distance = np.linalg.norm(r_ij, axis=1)
+    close = distance < cutoff
+
+    return i[close], j[close], r_ij[close], distance[close]
+
+
+def all_pairs(positions, cutoff, box_lengths, reflect_at_boundary):
+    """
+    Same as :func:`neighbor_pairs`, but checks all pairs of points
+    instead of using a grid of cells. This is faster for small
+    numbers of points or if `cutoff` is of the order of the box size.
+    """
+    positions = np.asarray(positions, dtype=float)
+    i, j = np.triu_indices(positions.shape[0], k=1)
+    r_ij = minimum_image(positions[j] - positions[i], box_lengths, reflect_at_boundary)
+    distance = np.linalg.norm(r_ij, axis=1)
+    close = distance < cutoff
+
+    return i[close], j[close], r_ij[close], distance[close]
+
+
+def _spread_bits(x):
+    """
+    Insert two zero bits between each of the lower 10 bits of `x`.
+    """
+    x = x & 0x3ff
+    x = (x | (x << 16)) & 0x030000ff
+    x = (x | (x << 8)) & 0x0300f00f
+    x = (x | (x << 4)) & 0x030c30c3
+    x = (x | (x << 2)) & 0x09249249
+    return x
+
+
+def morton_codes(positions, box_lengths, bits=10):
+    """
+    Return the Morton (Z-order) codes of `positions` (array of
+    shape ``(N, 3)``) on a grid with ``2**bits`` cells per dimension
+    spanning the box (at most 10 bits per dimension).
+    """
+    box_lengths = np.asarray(box_lengths, dtype=float)
+    n = 2**bits
+    cell = np.floor(np.asarray(positions, dtype=float) / box_lengths * n).astype(np.int64)
+    cell = np.clip(cell, 0, n-1)
+
+    return _spread_bits(cell[:,0]) | (_spread_bits(cell[:,1]) << 1) | (_spread_bits(cell[:,2]) << 2)
+
 
 if __name__=="__main__":
 
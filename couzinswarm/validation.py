@@ -0,0 +1,405 @@
+"""
+Validation module
+=================
+
+Contains functions to check whether an alternative way of simulating
+a swarm (an "engine") reproduces the behavior of the reference
+implementation :meth:`couzinswarm.simulation.Swarm.simulate`.
+
+An engine is a callable ``engine(swarm, N_time_steps)`` which simulates
+`swarm` for `N_time_steps` and returns the positions and directions as
+arrays of shape ``(N_fish, N_time_steps+1, 3)``, just like
+:meth:`couzinswarm.simulation.Swarm.simulate`.
+
+Runs without noise are compared step by step. Noisy runs are compared
+by the distributions of time-averaged order parameters and zone
+occupancies over independent replicas, using two-sample
+Kolmogorov-Smirnov tests.
+
+Example
+-------
+
+>>> from couzinswarm.validation import validate_engine
+>>> validate_engine(lambda swarm, N_t: my_fast_simulate(swarm, N_t))
+"""
+
+import copy
+import pickle
+
+import numpy as np
+
+from couzinswarm.simulation import Swarm
+from couzinswarm.analysis import zone_occupancy
+
+# parameter sets to validate engines with. The box lengths are at least twice
+# the interaction range such that each pair of fish interacts via
+# a single periodic image at most. The turning rate is high enough that
+# turns are not always capped, otherwise the noise would hardly be visible
+# in the trajectories.
+SCENARIOS = [
+        dict(number_of_fish=15,
+             repulsion_radius=1,
+             orientation_width=3,
+             attraction_width=5,
+             angle_of_perception=270/360*np.pi,
+             turning_rate=np.pi,
+             speed=3,
+             noise_sigma=0.05,
+             dt=0.1,
+             box_lengths=[20,20,20],
+             reflect_at_boundary=[True,True,True],
+            ),
+        dict(number_of_fish=15,
+             repulsion_radius=1,
+             orientation_width=3,
+             attraction_width=5,
+             angle_of_perception=np.pi,
+             turning_rate=np.pi,
+             speed=3,
+             noise_sigma=0.05,
+             dt=0.1,
+             box_lengths=[20,20,20],
+             reflect_at_boundary=[False,True,False],
+            ),
+    ]
+
+
+def reference_engine(swarm,N_time_steps):
+    """
+    The reference engine, :meth:`couzinswarm.simulation.Swarm.simulate`.
+    """
+    return swarm.simulate(N_time_steps)
+
+
+def ks_2samp(a,b):
+    """
+    Two-sample Kolmogorov-Smirnov test.
+
+    Parameters
+    ----------
+    a : numpy.ndarray
+        First sample.
+    b : numpy.ndarray
+        Second sample.
+
+    Returns
+    -------
+    D : float
+        Maximum distance between the two empirical distribution functions.
+    p : float
+        Asymptotic p-value of the null hypothesis that both samples
+        were drawn from the same distribution (using Stephens'
+        small-sample correction).
+    """
+
+    a = np.sort(np.asarray(a, dtype=float))
+    b = np.sort(np.asarray(b, dtype=float))
+    n, m = len(a), len(b)
+
+    x = np.concatenate((a, b))
+    cdf_a = np.searchsorted(a, x, side='right') / n
+    cdf_b = np.searchsorted(b, x, side='right') / m
+    D = np.abs(cdf_a - cdf_b).max()
+
+    en = np.sqrt(n * m / (n + m))
+    lam = (en + 0.12 + 0.11 / en) * D
+    if lam < 1e-3:
+        return float(D), 1.0
+    k = np.arange(1, 101)
+    p = 2 * np.sum((-1)**(k-1) * np.exp(-2 * k**2 * lam**2))
+
+    return float(D), float(np.clip(p, 0, 1))
+
+
+def observables(swarm,positions,directions,burn_in=0):
+    """
+    Compute time-averaged observables of a trajectory.
+
+    Parameters
+    ----------
+    swarm : :class:`couzinswarm.simulation.Swarm`
+        The swarm the trajectory was simulated with.
+    positions : numpy.ndarray of shape ``(N_fish, N_frames, 3)``
+    directions : numpy.ndarray of shape ``(N_fish, N_frames, 3)``
+    burn_in : int, default : 0
+        Number of initial frames to be ignored.
+
+    Returns
+    -------
+    observables : dict
+        Mean group polarization ``'polarization'``, mean
+        group angular momentum ``'angular_momentum'``, the mean angle
+        between consecutive directions of a fish ``'turning_angle'``, and
+        the mean number of neighbors in the zones of repulsion, orientation,
+        and attraction (``'n_r'``, ``'n_o'``, ``'n_a'``).
+    """
+
+    r = positions[:,burn_in:,:]
+    v = directions[:,burn_in:,:]
+
+    polarization = np.linalg.norm(v.mean(axis=0), axis=1)
+
+    r_ic = r - r.mean(axis=0)
+    r_ic /= np.linalg.norm(r_ic, axis=2)[:,:,None]
+    angular_momentum = np.linalg.norm(np.cross(r_ic, v).mean(axis=0), axis=1)
+
+    turning_angle = np.arccos(np.clip((v[:,1:,:] * v[:,:-1,:]).sum(axis=2), -1, 1))
+
+    hists = zone_occupancy(r, v,
+                           repulsion_radius=swarm.repulsion_radius,
+                           orientation_width=swarm.orientation_width,
+                           attraction_width=swarm.attraction_width,
+                           angle_of_perception=swarm.angle_of_perception,
+                           box_lengths=swarm.box_lengths,
+                           reflect_at_boundary=swarm.reflect_at_boundary,
+                           )
+    k = np.arange(swarm.number_of_fish)
+    n_r, n_o, n_a = [ (k*h).sum() / h.sum() for h in hists ]
+
+    return {
+            'polarization': polarization.mean(),
+            'angular_momentum': angular_momentum.mean(),
+            'turning_angle': turning_angle.mean(),
+            'n_r': n_r,
+            'n_o': n_o,
+            'n_a': n_a,
+           }
+
+
+def compare_deterministic(candidate,
+                          N_time_steps=50,
+                          reference=reference_engine,
+                          seed=0,
+                          atol=1e-6,
+                          **swarm_kwargs):
+    """
+    Simulate the same noiseless swarm with the reference and
+    the candidate engine and compare the trajectories step by step.
+
+    Parameters
+    ----------
+    candidate : callable
+        The engine to be validated.
+    N_time_steps : int, default : 50
+        Number of time steps to simulate. Rounding differences grow
+        over time, so this should be kept short.
+    reference : callable, default : :func:`reference_engine`
+        The engine to compare with.
+    seed : int, default : 0
+        Seed for the initial conditions.
+    atol : float, default : 1e-6
+        Maximum absolute deviation of positions and directions.
+    **swarm_kwargs
+        Passed on to :class:`couzinswarm.simulation.Swarm`,
+        ``noise_sigma`` is set to zero.
+
+    Returns
+    -------
+    result : dict
+        ``'passed'`` (bool), ``'max_deviation'`` (float), and
+        ``'first_failing_step'`` (int or None).
+    """
+
+    swarm_kwargs = dict(swarm_kwargs, noise_sigma=0)
+
+    np.random.seed(seed)
+    swarm = Swarm(**swarm_kwargs)
+    reference_swarm = copy.deepcopy(swarm)
+
+    r_ref, v_ref = reference(reference_swarm, N_time_steps)
+    r, v = candidate(swarm, N_time_steps)
+
+    if r.shape != r_ref.shape or v.shape != v_ref.shape:
+        raise ValueError("candidate returned arrays of shape %s, expected %s" % (r.shape, r_ref.shape))
+
+    deviation = np.maximum(np.abs(r - r_ref).max(axis=(0,2)),
+                           np.abs(v - v_ref).max(axis=(0,2)))
+    failing = np.nonzero(~(deviation <= atol))[0]
+
+    return {
+            'passed': len(failing) == 0,
+            'max_deviation': float(np.nanmax(deviation)) if np.isfinite(deviation).any() else np.nan,
+            'first_failing_step': int(failing[0]) if len(failing) > 0 else None,
+           }
+
+
+# samples of the reference engine, such that validating several
+# engines against the same reference only simulates it once
+_reference_samples = {}
+
+
+def _samples(engine,seeds,N_time_steps,burn_in,swarm_kwargs):
+    """
+    Simulate one replica per pair of seeds ``(initial_seed, noise_seed)``
+    and return the observables of all replicas as arrays.
+    """
+
+    samples = {}
+    for initial_seed, noise_seed in seeds:
+        np.random.seed(initial_seed)
+        swarm = Swarm(**swarm_kwargs)
+        np.random.seed(noise_seed)
+        r, v = engine(swarm, N_time_steps)
+        for name, value in observables(swarm, r, v, burn_in).items():
+            samples.setdefault(name, []).append(value)
+
+    return { name: np.array(values) for name, values in samples.items() }
+
+
+def compare_statistical(candidate,
+                        N_time_steps=60,
+                        n_replicas=40,
+                        burn_in=20,
+                        reference=reference_engine,
+                        seed=0,
+                        alpha=0.01,
+                        **swarm_kwargs):
+    """
+    Simulate independent replicas of a noisy swarm with both
+    the reference and the candidate engine and compare the distributions
+    of time-averaged observables (see :func:`observables`).
+
+    Every replica starts from its own random initial conditions, such that
+    all samples are independent. For each observable, a two-sample
+    Kolmogorov-Smirnov test is performed. The test is passed if no p-value
+    is below the Bonferroni-corrected significance level. Samples of
+    :func:`reference_engine` are computed once per set of arguments and
+    reused, other references are simulated on every call.
+
+    Parameters
+    ----------
+    candidate : callable
+        The engine to be validated.
+    N_time_steps : int, default : 60
+        Number of time steps per replica.
+    n_replicas : int, default : 40
+        Number of replicas per engine.
+    burn_in : int, default : 20
+        Number of initial frames ignored in observables.
+    reference : callable, default : :func:`reference_engine`
+        The engine to compare with.
+    seed : int, default : 0
+        Seed of the first replica.
+    alpha : float, default : 0.01
+        Family-wise significance level.
+    **swarm_kwargs
+        Passed on to :class:`couzinswarm.simulation.Swarm`.
+
+    Returns
+    -------
+    result : dict
+        ``'passed'`` (bool) and ``'tests'``, a dict containing for each
+        observable a tuple ``(D, p)`` of the test statistic and the p-value.
+    """
+
+    # both engines use disjoint seeds for initial conditions and noise
+    replicas = np.arange(n_replicas)
+    reference_seeds = list(zip(seed + replicas, seed + n_replicas + replicas))
+    candidate_seeds = list(zip(seed + 2*n_replicas + replicas, seed + 3*n_replicas + replicas))
+
+    # only samples of the built-in reference are reused, other
+    # references may be closures which can't be told apart reliably
+    if reference is reference_engine:
+        key = pickle.dumps((N_time_steps, n_replicas, burn_in, seed, sorted(swarm_kwargs.items())))
+        if key not in _reference_samples:
+            _reference_samples[key] = _samples(reference, reference_seeds, N_time_steps, burn_in, swarm_kwargs)
+        reference_samples = _reference_samples[key]
+    else:
+        reference_samples = _samples(reference, reference_seeds, N_time_steps, burn_in, swarm_kwargs)
+    candidate_samples = _samples(candidate, candidate_seeds, N_time_steps, burn_in, swarm_kwargs)
+
+    tests = { name: ks_2samp(reference_samples[name], candidate_samples[name]) for name in reference_samples }
+    passed = all(p >= alpha / len(tests) for D, p in tests.values())
+
+    return {
+            'passed': passed,
+            'tests': tests,
+           }
+
+
+def negative_control(engine=reference_engine,noise_factor=3.0):
+    """
+    Return a deliberately wrong engine, which simulates with `engine`
+    but with the noise amplified by `noise_factor`. A statistical
+    comparison which does not reject this engine is not
+    powerful enough to detect errors.
+    """
+
+    def wrong_engine(swarm,N_time_steps):
+        swarm.noise_sigma = noise_factor * np.asarray(swarm.noise_sigma)
+        return engine(swarm, N_time_steps)
+
+    return wrong_engine
+
+
+def validate_engine(candidate,
+                    scenarios=None,
+                    deterministic_kwargs={},
+                    statistical_kwargs={},
+                    reference=reference_engine,
+                    check_power=True,
+                    ):
+    """
+    Run deterministic and statistical comparisons between
+    the candidate and the reference engine for all scenarios.
+
+    If `check_power` is `True`, the statistical comparison is also run with
+    a deliberately wrong version of the candidate (see :func:`negative_control`),
+    which has to be rejected.
+
+    Parameters
+    ----------
+    candidate : callable
+        The engine to be validated.
+    scenarios : list of dict, default : None
+        Keyword arguments of :class:`couzinswarm.simulation.Swarm`
+        for each scenario. If `None`, use :data:`SCENARIOS`.
+    deterministic_kwargs : dict, default : {}
+        Passed on to :func:`compare_deterministic`.
+    statistical_kwargs : dict, default : {}
+        Passed on to :func:`compare_statistical`.
+    reference : callable, default : :func:`reference_engine`
+        The engine to compare with.
+    check_power : bool, default : True
+        Whether to check that the statistical comparison
+        rejects the negative control.
+
+    Returns
+    -------
+    reports : list of tuple of dict
+        The results of :func:`compare_deterministic` and
+        :func:`compare_statistical` for each scenario.
+
+    Raises
+    ------
+    AssertionError
+        If any of the comparisons failed.
+    """
+
+    if scenarios is None:
+        scenarios = SCENARIOS
+
+    reports = []
+    failures = []
+    for k, scenario in enumerate(scenarios):
+        deterministic = compare_deterministic(candidate, reference=reference, **dict(scenario, **deterministic_kwargs))
+        statistical = compare_statistical(candidate, reference=reference, **dict(scenario, **statistical_kwargs))
+        reports.append((deterministic, statistical))
+
+        if not deterministic['passed']:
+            failures.append("scenario %d: trajectories deviate by %g from step %d on" % (
+                            k, deterministic['max_deviation'], deterministic['first_failing_step']))
+        if not statistical['passed']:
+            failures.append("scenario %d: observable distributions differ %s" % (
+                            k, { name: p for name, (D, p) in statistical['tests'].items() }))
+
+        if check_power:
+            control = compare_statistical(negative_control(candidate), reference=reference, **dict(scenario, **statistical_kwargs))
+            if control['passed']:
+                failures.append("scenario %d: the statistical comparison does not reject the negative control %s" % (
+                                k, { name: p for name, (D, p) in control['tests'].items() }))
+
+    if len(failures) > 0:
+        raise AssertionError("\n".join(failures))
+
+    return reports
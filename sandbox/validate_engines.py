@@ -0,0 +1,43 @@
+from couzinswarm.validation import validate_engine
+
+# engines to be validated against the reference loop,
+# given as keyword arguments of Swarm
+ENGINES = {
+        'vectorized': dict(engine='vectorized'),
+        'neighbor_list': dict(engine='neighbor_list'),
+        'neighbor_list, exact octree': dict(engine='neighbor_list', opening_angle=0),
+        'vectorized, reordered every step': dict(engine='vectorized', reorder_interval=1),
+    }
+
+
+def make_engine(**kwargs):
+
+    def engine(swarm, N_time_steps):
+        for name, value in kwargs.items():
+            setattr(swarm, name, value)
+        return swarm.simulate(N_time_steps)
+
+    return engine
+
+
+if __name__ == "__main__":
+
+    failed = []
+    for name, kwargs in ENGINES.items():
+        print(name)
+        try:
+            reports = validate_engine(make_engine(**kwargs))
+        except AssertionError as e:
+            print("    FAILED\n   ", str(e).replace("\n", "\n    "))
+            failed.append(name)
+            continue
+
+        for k, (deterministic, statistical) in enumerate(reports):
+            print("    scenario %d: max. deviation %.1e, min. p-value %.3f" % (
+                  k,
+                  deterministic['max_deviation'],
+                  min(p for D, p in statistical['tests'].values()),
+                  ))
+
+    if len(failed) > 0:
+        raise SystemExit("engines failed validation: " + ", ".join(failed))